@@ -0,0 +1,48 @@
+"""
+Benchmarks for the orders service.
+
+Run them from the directory, which contains `manage.py`, e.g.
+
+    $ python3 -m benchmarks.connection_scaling --connections 1000
+
+The benchmarks use a throwaway SQLite database and the
+in-memory channel layer, so no redis instance is needed.
+"""
+import math
+import os
+
+
+def setup():
+    """Configure django with the benchmark settings and a fresh database."""
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+    import django
+    from django.conf import settings
+    from django.core.management import call_command
+
+    # including the write-ahead log of the WAL journal mode
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(settings.DATABASES["default"]["NAME"] + suffix):
+            os.remove(settings.DATABASES["default"]["NAME"] + suffix)
+
+    django.setup()
+    call_command("migrate", verbosity=0)
+
+
+def percentile(values, p):
+    """Return the p-th percentile of the values (nearest rank)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(p / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def report(title, rows):
+    """Print the rows of (label, value) pairs of a benchmark."""
+    print(title)
+    width = max(len(label) for label, _ in rows)
+    for label, value in rows:
+        if isinstance(value, float):
+            value = "{:.3f}".format(value)
+        print("  {}  {}".format(label.ljust(width), value))
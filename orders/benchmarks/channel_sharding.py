@@ -0,0 +1,188 @@
+"""
+Verify the placement of the session groups on the shards of the channel layer.
+
+- placement: session groups are spread evenly over the shards, and the
+  sharded Redis layer places them by their code like the hash ring
+- rebalancing: adding a shard only moves about 1/(N+1) of the session
+  groups, removing one only moves the groups of the removed shard,
+  compared with the modulo placement of the plain Redis layer
+- routing: order events reach sockets on `ws/session/<code>/` through
+  in-process stand-ins of the shards, before and after adding a shard
+
+Exits with 1, if one of the checks fails.
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+
+from . import report, setup
+
+
+def layer_config(shards, virtual_nodes):
+    return {
+        "default": {
+            "BACKEND": "benchmarks.layers.ShardedInMemoryChannelLayer",
+            "CONFIG": {"shards": shards, "virtual_nodes": virtual_nodes},
+        }
+    }
+
+
+def moved(codes, before, after) -> list:
+    """Get the codes, whose shard differs between the placements."""
+    return [code for code in codes if before(code) != after(code)]
+
+
+def check_placement(codes, shards, virtual_nodes) -> list:
+    from channels_redis.core import RedisChannelLayer
+
+    from orders.sharding import HashRing, ShardedRedisChannelLayer
+
+    failures = []
+    hosts = [(shard, 6379) for shard in shards]
+    ring = HashRing(["{}:6379".format(shard) for shard in shards], virtual_nodes)
+    layer = ShardedRedisChannelLayer(hosts=hosts, virtual_nodes=virtual_nodes)
+    if any(layer.consistent_hash("session_{}".format(code)) != ring.nodes.index(ring.node(code)) for code in codes):
+        failures.append("the sharded redis layer does not place session groups by their code")
+
+    counts = {shard: 0 for shard in ring.nodes}
+    for code in codes:
+        counts[ring.node(code)] += 1
+    mean = len(codes) / len(shards)
+    imbalance = max(counts.values()) / mean
+    if imbalance > 1.25:
+        failures.append("the busiest shard holds {:.2f} times the mean".format(imbalance))
+
+    grown = HashRing(list(ring.nodes) + ["shard{}:6379".format(len(shards))], virtual_nodes)
+    shrunk = HashRing(ring.nodes[:-1], virtual_nodes)
+    moved_on_add = moved(codes, ring.node, grown.node)
+    moved_on_remove = moved(codes, ring.node, shrunk.node)
+    if len(moved_on_add) > 2 * len(codes) / (len(shards) + 1):
+        failures.append("adding a shard moved {} of {} groups".format(len(moved_on_add), len(codes)))
+    if any(ring.node(code) != ring.nodes[-1] for code in moved_on_remove):
+        failures.append("removing a shard moved groups between the remaining shards")
+
+    modulo = RedisChannelLayer(hosts=hosts)
+    modulo_grown = RedisChannelLayer(hosts=hosts + [("shard{}".format(len(shards)), 6379)])
+    moved_modulo = moved(
+        codes,
+        lambda code: modulo.consistent_hash("session_{}".format(code)),
+        lambda code: modulo_grown.consistent_hash("session_{}".format(code)),
+    )
+
+    report("placement of {} session groups on {} shards".format(len(codes), len(shards)), [
+        ("groups per shard", ", ".join(str(count) for count in counts.values())),
+        ("busiest shard / mean", imbalance),
+        ("moved on adding a shard [%]", len(moved_on_add) / len(codes) * 100),
+        ("moved on removing a shard [%]", len(moved_on_remove) / len(codes) * 100),
+        ("moved on adding a shard, modulo [%]", len(moved_modulo) / len(codes) * 100),
+    ])
+    return failures
+
+
+async def check_routing(codes, shards, virtual_nodes) -> list:
+    from channels.db import database_sync_to_async
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+    from django.test import Client, override_settings
+
+    from orders.broadcast import dispatcher
+    from orders.routing import application
+    from orders.sharding import shard_key
+
+    failures = []
+    with override_settings(CHANNEL_LAYERS=layer_config(shards, virtual_nodes)):
+        channel_layer = get_channel_layer()
+        dispatcher.bind(asyncio.get_event_loop())
+
+        communicators = {}
+        for code in codes:
+            communicator = WebsocketCommunicator(application, "/ws/session/{}/".format(code))
+            connected, _ = await communicator.connect()
+            assert connected
+            await communicator.receive_from()
+            communicators[code] = communicator
+
+        def add_product(code):
+            client = Client()
+            response = client.post(
+                "/orders/products/add/",
+                json.dumps({"session_code": code, "product_id": 1}),
+                content_type="application/json",
+            )
+            assert response.status_code == 200, response.content
+
+        received = 0
+        for code, communicator in communicators.items():
+            await database_sync_to_async(add_product)(code)
+            frame = json.loads(await communicator.receive_from(timeout=10))
+            # the full session without SESSION_BROADCAST_DELTAS, an order event otherwise
+            if frame.get("session_code", frame.get("session", {}).get("code")) == code:
+                received += 1
+
+        for communicator in communicators.values():
+            await communicator.disconnect()
+        dispatcher.bind(None)
+
+        misrouted = [
+            group for group, shard in channel_layer.routes.items()
+            if shard != channel_layer.ring.node(shard_key(group))
+        ]
+        if received != len(codes):
+            failures.append("{} of {} sockets received their order event".format(received, len(codes)))
+        if misrouted:
+            failures.append("{} groups were sent on the wrong shard".format(len(misrouted)))
+
+        session_shards = {
+            shard for group, shard in channel_layer.routes.items() if group.startswith("session_")
+        }
+        report("routing through {} stand-in shards".format(len(shards)), [
+            ("sockets, which received their event", "{} / {}".format(received, len(codes))),
+            ("shards with session group sends", "{} / {}".format(len(session_shards), len(shards))),
+            ("misrouted group sends", len(misrouted)),
+        ])
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shards", type=int, default=4)
+    parser.add_argument("--virtual-nodes", type=int, default=128)
+    parser.add_argument("--groups", type=int, default=10000, help="session codes of the placement check")
+    parser.add_argument("--sockets", type=int, default=50, help="sockets of the routing check")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    setup()
+    from orders.broadcast import dispatcher
+    from orders.models import Session
+
+    random.seed(args.seed)
+    codes = ["{:06d}".format(code) for code in random.sample(range(10 ** 6), args.groups)]
+    shards = ["shard{}".format(index) for index in range(args.shards)]
+
+    failures = check_placement(codes, shards, args.virtual_nodes)
+
+    sockets = codes[:args.sockets]
+    for code in sockets:
+        Session.objects.create(code=code, name="Sharding {}".format(code), location_id=1)
+    # the sockets only receive the order events
+    dispatcher.flush()
+    loop = asyncio.get_event_loop()
+    failures += loop.run_until_complete(check_routing(sockets, shards, args.virtual_nodes))
+    # the sockets subscribe again after adding a shard
+    failures += loop.run_until_complete(
+        check_routing(sockets, shards + ["shard{}".format(args.shards)], args.virtual_nodes)
+    )
+
+    if failures:
+        print("Failed:")
+        for failure in failures:
+            print("  {}".format(failure))
+        sys.exit(1)
+    print("All checks passed.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Open N concurrent sockets on `ws/session/<code>/` and measure
+the memory per connection and the fan-out latency of session updates.
+"""
+import argparse
+import asyncio
+import json
+import time
+import tracemalloc
+
+from . import percentile, report, setup
+
+
+async def run(connections, rounds):
+    from channels.layers import get_channel_layer
+    from channels.testing import WebsocketCommunicator
+
+    from orders.models import Session
+    from orders.routing import application
+
+    session = Session.objects.create(code="bench1", name="Benchmark", location_id=1)
+    channel_layer = get_channel_layer()
+
+    tracemalloc.start()
+    memory_before, _ = tracemalloc.get_traced_memory()
+
+    communicators = []
+    for _ in range(connections):
+        communicator = WebsocketCommunicator(
+            application, "/ws/session/{}/".format(session.code)
+        )
+        connected, _ = await communicator.connect()
+        assert connected
+        await communicator.receive_from()
+        communicators.append(communicator)
+
+    memory_after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = []
+
+    async def receive(communicator, sent_at):
+        await communicator.receive_from(timeout=30)
+        latencies.append(time.perf_counter() - sent_at)
+
+    for sequence in range(rounds):
+        sent_at = time.perf_counter()
+        await channel_layer.group_send(session.group_name, {
+            "type": "session_update",
+            "frames": [json.dumps({"event": "benchmark", "sequence": sequence})],
+        })
+        await asyncio.gather(*(
+            receive(communicator, sent_at) for communicator in communicators
+        ))
+
+    for communicator in communicators:
+        await communicator.disconnect()
+
+    report("connection scaling ({} sockets, {} rounds)".format(connections, rounds), [
+        ("memory per connection [KiB]", (memory_after - memory_before) / connections / 1024),
+        ("fan-out latency p50 [ms]", percentile(latencies, 50) * 1000),
+        ("fan-out latency p99 [ms]", percentile(latencies, 99) * 1000),
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--connections", type=int, default=500)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+    asyncio.get_event_loop().run_until_complete(run(args.connections, args.rounds))
+
+
+if __name__ == "__main__":
+    main()
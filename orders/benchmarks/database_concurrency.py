@@ -0,0 +1,103 @@
+"""
+Measure mixed `add_product_to_session` / `get_session` traffic on SQLite
+with the rollback journal and with the WAL journal mode of the sqlite profile.
+
+Every thread uses its own connection, like the worker threads of the service.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+
+from . import percentile, report, setup
+
+
+JOURNALS = {
+    "rollback journal": {"journal_mode": "DELETE", "synchronous": "FULL"},
+    "WAL": {"journal_mode": "WAL", "synchronous": "NORMAL"},
+}
+
+
+def run_traffic(label, requests, threads, read_ratio, sessions):
+    from django.db import connection
+    from django.test import Client
+
+    reads, writes = [], []
+    errors = []
+
+    def worker(index):
+        client = Client()
+        generator = random.Random(index)
+        for number in range(index, requests, threads):
+            session_code = generator.choice(sessions)
+            started_at = time.perf_counter()
+            try:
+                if generator.random() < read_ratio:
+                    response = client.get("/orders/sessions/get/{}/".format(session_code))
+                    latencies = reads
+                else:
+                    response = client.post("/orders/products/add/", json.dumps({
+                        "session_code": session_code,
+                        "product_id": number + 1,
+                    }), content_type="application/json")
+                    latencies = writes
+            except Exception as e:
+                # e.g. "database is locked" after the busy timeout
+                errors.append(e)
+                continue
+            latencies.append(time.perf_counter() - started_at)
+            assert response.status_code == 200, response.content
+        connection.close()
+
+    started_at = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    duration = time.perf_counter() - started_at
+
+    return [
+        ("{} requests/s".format(label), (len(reads) + len(writes)) / duration),
+        ("{} get_session p50 [ms]".format(label), percentile(reads, 50) * 1000),
+        ("{} get_session p99 [ms]".format(label), percentile(reads, 99) * 1000),
+        ("{} add_product p50 [ms]".format(label), percentile(writes, 50) * 1000),
+        ("{} add_product p99 [ms]".format(label), percentile(writes, 99) * 1000),
+        ("{} errors".format(label), len(errors)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--read-ratio", type=float, default=0.8)
+    parser.add_argument("--sessions", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.conf import settings
+    from django.db import connections
+    from orders.models import Session
+
+    sessions = [
+        Session.objects.create(code="d{:05d}".format(number), name="Table {}".format(number), location_id=1).code
+        for number in range(args.sessions)
+    ]
+
+    rows = []
+    pragmas = settings.DATABASES["default"]["PRAGMAS"]
+    for label, journal in JOURNALS.items():
+        # the journal mode can only be changed without other connections
+        connections.close_all()
+        pragmas.update(journal)
+        rows += run_traffic(label, args.requests, args.threads, args.read_ratio, sessions)
+    report("mixed traffic ({} requests, {} threads, {:.0%} reads)".format(
+        args.requests, args.threads, args.read_ratio
+    ), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""
+Measure the JSON encoding of sessions with 10, 100 and 1000 orders.
+
+The "isoformat" baseline converts the timestamps in Python and encodes
+with `DjangoJSONEncoder`, like the responses did before the encoder layer.
+The broadcast rows compare encoding a message once to encoding it per socket.
+"""
+import argparse
+import json
+import time
+from datetime import timedelta
+
+from . import percentile, report, setup
+
+
+def build_session(orders):
+    from django.utils import timezone
+
+    now = timezone.now()
+    return {
+        "code": "ABC123",
+        "name": "Table 1",
+        "location_id": 1,
+        "state": "OPEN",
+        "timestamp": now,
+        "sequence": orders,
+        "orders": [
+            {"id": i, "product_id": i % 50, "session": "ABC123", "timestamp": now + timedelta(seconds=i)}
+            for i in range(orders)
+        ],
+    }
+
+
+def isoformat_baseline(session):
+    from django.core.serializers.json import DjangoJSONEncoder
+
+    session = dict(session, timestamp=session["timestamp"].isoformat(), orders=[
+        dict(order, timestamp=order["timestamp"].isoformat()) for order in session["orders"]
+    ])
+    return json.dumps(session, cls=DjangoJSONEncoder).encode()
+
+
+def measure(func, iterations):
+    latencies = []
+    for _ in range(iterations):
+        started_at = time.perf_counter()
+        func()
+        latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--sockets", type=int, default=100, help="subscribers of a broadcast")
+    args = parser.parse_args()
+
+    setup()
+    from orders import encoding
+
+    encoders = {"isoformat": isoformat_baseline, "json": encoding.dumps_stdlib}
+    if encoding.orjson is not None:
+        encoders["orjson"] = encoding.dumps_orjson
+
+    rows = []
+    for orders in (10, 100, 1000):
+        session = build_session(orders)
+        for label, encode in encoders.items():
+            latencies = measure(lambda: encode(session), args.iterations)
+            rows.append(("{} orders, {} p50 [ms]".format(orders, label), percentile(latencies, 50) * 1000))
+
+    order = build_session(1)["orders"][0]
+    message = {"event": "order_added", "sequence": 1, "session_code": "ABC123", "order": order}
+    converted = dict(message, order=dict(order, timestamp=order["timestamp"].isoformat()))
+    per_socket = measure(lambda: [json.dumps(converted) for _ in range(args.sockets)], args.iterations)
+    once = measure(lambda: encoding.dumps(message), args.iterations)
+    rows.append(("broadcast, per socket p50 [ms]", percentile(per_socket, 50) * 1000))
+    rows.append(("broadcast, once p50 [ms]", percentile(once, 50) * 1000))
+
+    report("JSON encoding ({} iterations, {} sockets, {} encoder)".format(
+        args.iterations, args.sockets, encoding.get_encoder().__name__
+    ), rows)
+
+
+if __name__ == "__main__":
+    main()
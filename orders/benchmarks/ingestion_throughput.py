@@ -0,0 +1,88 @@
+"""
+Compare the order throughput of `add_product_to_session`
+with the direct and the buffered order ingestion.
+"""
+import argparse
+import json
+import os
+import tempfile
+import threading
+import time
+
+from . import percentile, report, setup
+
+
+def place_orders(mode, orders, threads, sessions):
+    from django.conf import settings
+    from django.db import connection
+    from django.test import Client
+
+    from orders.ingestion import order_log
+    from orders.models import Order
+
+    settings.ORDER_INGESTION = mode
+    orders_before = Order.objects.count()
+    latencies = []
+
+    def worker(index):
+        client = Client()
+        for number in range(index, orders, threads):
+            started_at = time.perf_counter()
+            response = client.post("/orders/products/add/", json.dumps({
+                "session_code": sessions[number % len(sessions)],
+                "product_id": number + 1,
+            }), content_type="application/json")
+            latencies.append(time.perf_counter() - started_at)
+            assert response.status_code in (200, 202), response.content
+        connection.close()
+
+    started_at = time.perf_counter()
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    acknowledged_after = time.perf_counter() - started_at
+
+    if mode == "buffered":
+        order_log.flush_all()
+    inserted_after = time.perf_counter() - started_at
+    assert Order.objects.count() - orders_before == orders
+
+    return [
+        ("{} acknowledged orders/s".format(mode), orders / acknowledged_after),
+        ("{} inserted orders/s".format(mode), orders / inserted_after),
+        ("{} latency p50 [ms]".format(mode), percentile(latencies, 50) * 1000),
+        ("{} latency p99 [ms]".format(mode), percentile(latencies, 99) * 1000),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--orders", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=20)
+    args = parser.parse_args()
+
+    setup()
+
+    from django.conf import settings
+    from orders.models import Session
+
+    settings.ORDER_INGESTION_LOG = os.path.join(tempfile.gettempdir(), "orders-benchmark.ingestion.log")
+    if os.path.exists(settings.ORDER_INGESTION_LOG):
+        os.remove(settings.ORDER_INGESTION_LOG)
+
+    sessions = [
+        Session.objects.create(code="b{:05d}".format(number), name="Table {}".format(number), location_id=1).code
+        for number in range(args.sessions)
+    ]
+
+    rows = []
+    for mode in ("direct", "buffered"):
+        rows += place_orders(mode, args.orders, args.threads, sessions)
+    report("order ingestion ({} orders, {} threads)".format(args.orders, args.threads), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+"""
+In-process stand-in for the sharded Redis channel layer.
+
+Every shard is an in-memory channel layer. Like on Redis, the membership
+of a group is stored on the shard of the group, and the messages of a
+group send are delivered to the shards of the channels.
+"""
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer, InMemoryChannelLayer
+
+from orders.sharding import HashRing, shard_key
+
+
+class ShardedInMemoryChannelLayer(BaseChannelLayer):
+
+    extensions = ["groups", "flush"]
+
+    def __init__(self, shards=("shard0", "shard1", "shard2"), virtual_nodes=128,
+                 expiry=60, group_expiry=86400, capacity=100, channel_capacity=None, **kwargs):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.layers = {
+            shard: InMemoryChannelLayer(
+                expiry=expiry, group_expiry=group_expiry, capacity=capacity, channel_capacity=channel_capacity
+            )
+            for shard in shards
+        }
+        self.ring = HashRing(shards, virtual_nodes)
+        # {group: shard} of the group sends
+        self.routes = {}
+
+    @property
+    def channels(self):
+        # the queues of all shards, e.g. for the channel layer usage
+        return {
+            channel: queue
+            for layer in self.layers.values() for channel, queue in layer.channels.items()
+        }
+
+    def shard(self, name):
+        return self.ring.node(shard_key(name))
+
+    async def send(self, channel, message):
+        await self.layers[self.shard(channel)].send(channel, message)
+
+    async def receive(self, channel):
+        return await self.layers[self.shard(channel)].receive(channel)
+
+    async def new_channel(self, prefix="specific."):
+        return await self.layers[self.ring.nodes[0]].new_channel(prefix)
+
+    async def flush(self):
+        for layer in self.layers.values():
+            await layer.flush()
+        self.routes = {}
+
+    async def group_add(self, group, channel):
+        await self.layers[self.shard(group)].group_add(group, channel)
+
+    async def group_discard(self, group, channel):
+        await self.layers[self.shard(group)].group_discard(group, channel)
+
+    async def group_send(self, group, message):
+        assert self.valid_group_name(group), "Group name not valid"
+        shard = self.routes[group] = self.shard(group)
+        for channel in list(self.layers[shard].groups.get(group, {})):
+            try:
+                await self.send(channel, message)
+            except ChannelFull:
+                pass
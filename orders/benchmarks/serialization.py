@@ -0,0 +1,82 @@
+"""
+Measure the serialization of sessions with 10, 100 and 1000 orders.
+
+The `model_to_dict` baseline instantiates the session and all of its
+orders as models, like `dict_representation` did before the read models.
+Reports the CPU time and the peak of memory allocated per serialization.
+"""
+import argparse
+import time
+import tracemalloc
+
+from . import percentile, report, setup
+
+
+def create_session(code, orders):
+    from orders.models import Order, Session
+
+    session = Session.objects.create(code=code, name=code, location_id=1)
+    Order.objects.bulk_create(
+        Order(session=session, product_id=i % 50) for i in range(orders)
+    )
+    return session
+
+
+def model_to_dict_baseline(code):
+    from django.forms.models import model_to_dict
+    from orders.models import Session
+
+    session = Session.objects.get(code=code)
+    session_dict = model_to_dict(session)
+    session_dict["orders"] = [model_to_dict(order) for order in session.order_set.all()]
+    return session_dict
+
+
+def read_model(code):
+    from orders.models import Session
+    from orders.serializers import serialize_sessions
+
+    return serialize_sessions(Session.objects.filter(code=code))[0]
+
+
+def measure(func, iterations):
+    latencies = []
+    for _ in range(iterations):
+        started_at = time.process_time()
+        func()
+        latencies.append(time.process_time() - started_at)
+    return latencies
+
+
+def peak_allocation(func):
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=100)
+    args = parser.parse_args()
+
+    setup()
+
+    serializers = {"model_to_dict": model_to_dict_baseline, "read model": read_model}
+    rows = []
+    for orders in (10, 100, 1000):
+        code = str(orders)
+        create_session(code, orders)
+        for label, serialize in serializers.items():
+            latencies = measure(lambda: serialize(code), args.iterations)
+            rows.append(("{} orders, {} p50 [ms]".format(orders, label), percentile(latencies, 50) * 1000))
+            rows.append(("{} orders, {} peak [KiB]".format(orders, label),
+                         peak_allocation(lambda: serialize(code)) / 1024))
+
+    report("serialization ({} iterations)".format(args.iterations), rows)
+
+
+if __name__ == "__main__":
+    main()
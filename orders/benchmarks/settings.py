@@ -0,0 +1,23 @@
+import os
+import tempfile
+
+from orders.settings import *  # noqa: F401,F403
+
+
+DEBUG = False
+
+DATABASES = {
+    'default': dict(
+        DATABASE_PROFILES['sqlite'],  # noqa: F405
+        NAME=os.path.join(tempfile.gettempdir(), 'orders-benchmark.sqlite3'),
+    )
+}
+
+CHANNEL_LAYERS = {
+    'default': {
+        'BACKEND': 'channels.layers.InMemoryChannelLayer',
+    }
+}
+
+# the suite reads the query counts from the instrumentation
+METRICS_ENABLED = True
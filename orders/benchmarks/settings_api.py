@@ -0,0 +1,3 @@
+from orders.settings_api import *  # noqa: F401,F403
+
+from .settings import CHANNEL_LAYERS, DATABASES, DEBUG, METRICS_ENABLED  # noqa: F401
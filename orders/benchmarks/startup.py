@@ -0,0 +1,132 @@
+"""
+Compare the startup and the per-connect cost of the full settings profile
+with the slim API worker profile (`orders.settings_api`).
+
+Every profile is started in fresh processes, which set up django and
+load the ASGI application. Then sockets connect to `ws/session/<code>/`
+one after the other, and the time until the first frame and the database
+queries per connect are measured.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from . import percentile, report
+
+
+PROFILES = {
+    "full": "benchmarks.settings",
+    "api": "benchmarks.settings_api",
+}
+
+
+def child(connects):
+    started_at = time.perf_counter()
+    import django
+    django.setup()
+    from channels.routing import get_default_application
+    application = get_default_application()
+    startup = time.perf_counter() - started_at
+    modules = len(sys.modules)
+    # the heavy modules, which should only be loaded when needed
+    loaded = [module for module in ("requests", "twisted", "django.contrib.admin") if module in sys.modules]
+
+    from . import setup
+    setup()
+
+    from channels.testing import WebsocketCommunicator
+    from django.db import connection
+    from django.db.backends.signals import connection_created
+
+    from orders.models import Session
+
+    queries = []
+
+    def count(execute, sql, params, many, context):
+        queries.append(sql)
+        return execute(sql, params, many, context)
+
+    def count_queries(sender, connection, **kwargs):
+        # closed connections are opened again on the same wrapper
+        if count not in connection.execute_wrappers:
+            connection.execute_wrappers.append(count)
+
+    # the consumers query on the connections of their thread pool
+    connection_created.connect(count_queries)
+    connection.execute_wrappers.append(count)
+
+    session = Session.objects.create(code="boot01", name="Startup", location_id=1)
+
+    async def run():
+        latencies = []
+        for _ in range(connects):
+            started_at = time.perf_counter()
+            communicator = WebsocketCommunicator(application, "/ws/session/{}/".format(session.code))
+            connected, _ = await communicator.connect()
+            assert connected
+            await communicator.receive_from()
+            latencies.append(time.perf_counter() - started_at)
+            await communicator.disconnect()
+        return latencies
+
+    del queries[:]
+    latencies = asyncio.get_event_loop().run_until_complete(run())
+    print(json.dumps({
+        "startup": startup,
+        "modules": modules,
+        "loaded": loaded,
+        "latencies": latencies,
+        "queries": len(queries) / connects,
+    }))
+
+
+def measure(settings_module, runs, connects) -> dict:
+    results = []
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-W", "ignore", "-m", "benchmarks.startup", "--child", "--connects", str(connects)],
+            env=dict(os.environ, DJANGO_SETTINGS_MODULE=settings_module),
+        )
+        results.append(json.loads(output.decode().splitlines()[-1]))
+    latencies = [latency for result in results for latency in result["latencies"]]
+    return {
+        "startup": statistics.median(result["startup"] for result in results),
+        "modules": results[-1]["modules"],
+        "loaded": results[-1]["loaded"],
+        "latencies": latencies,
+        "queries": statistics.mean(result["queries"] for result in results),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5, help="processes per profile")
+    parser.add_argument("--connects", type=int, default=200, help="sockets per process")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.connects)
+        return
+
+    for name, settings_module in PROFILES.items():
+        result = measure(settings_module, args.runs, args.connects)
+        report("{} profile ({}, {} processes, {} connects each)".format(
+            name, settings_module, args.runs, args.connects
+        ), [
+            ("startup, median [ms]", result["startup"] * 1000),
+            ("loaded modules", result["modules"]),
+            ("loaded heavy modules", ", ".join(result["loaded"]) or "-"),
+            ("connect p50 [ms]", percentile(result["latencies"], 50) * 1000),
+            ("connect p99 [ms]", percentile(result["latencies"], 99) * 1000),
+            ("queries per connect", result["queries"]),
+        ])
+
+
+if __name__ == "__main__":
+    main()
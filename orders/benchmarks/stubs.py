@@ -0,0 +1,69 @@
+"""
+Local stand-ins for the verification, locations and codes services.
+
+All stubs are served by one threaded HTTP server, which answers every request
+after a configurable delay. Every user owns the location with the same id.
+"""
+import itertools
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LOCATION_PATH = re.compile(r"^/locations/get/(\d+)/$")
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # keep-alive connections would otherwise stall on delayed acks
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.path == "/codes/new/":
+            self.respond(200, {"value": "{:06x}".format(next(self.server.codes))})
+            return
+        match = LOCATION_PATH.match(self.path)
+        if match:
+            self.respond(200, {"user_id": int(match.group(1))})
+            return
+        self.respond(404, {})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.delay)
+        if self.path == "/verification/verify/":
+            self.respond(200, {})
+            return
+        self.respond(404, {})
+
+    def respond(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stubs(delay=0.0, first_code=0x100000) -> str:
+    """Start the stub services in the background and return their base url."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+    server.daemon_threads = True
+    server.delay = delay
+    server.codes = itertools.count(first_code)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return "http://127.0.0.1:{}".format(server.server_address[1])
+
+
+def use_stubs(url):
+    """Point the upstream service settings to the stubs."""
+    from django.conf import settings
+    settings.VERIFICATION_SERVICE_URL = url
+    settings.LOCATIONS_SERVICE_URL = url
+    settings.CODES_SERVICE_URL = url
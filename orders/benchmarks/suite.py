@@ -0,0 +1,296 @@
+"""
+Drive realistic traffic against local stub services and the in-memory
+channel layer, and compare the results with a stored baseline.
+
+Scenarios:
+
+- create_session: bursts of concurrent session creations
+- hot_sessions: concurrent add_product_to_session into a few sessions
+- find_session: paging through a large location with cursors
+- ws_fanout: order events to many ws/session/<code>/ subscribers
+
+Every scenario reports its throughput, p50/p99 latency and database queries
+per request. With --save-baseline, the queries per request are stored as the
+baseline, together with the run parameters. Otherwise they are compared with
+it, and the run fails on regressions. Query counts depend on the run parameters,
+so runs with other parameters than the baseline are not compared. Timings
+depend on the machine, so they are reported, but never compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+
+from . import percentile, report, setup
+from .stubs import start_stubs, use_stubs
+
+
+BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# arguments, on which the queries per request depend
+PARAMETERS = ("threads", "sessions", "hot_sessions", "orders", "location_sessions", "subscribers", "rounds")
+
+
+def request_queries(view) -> tuple:
+    """Get the `(queries, requests)` of a view, which were recorded by the instrumentation."""
+    from orders.instrumentation import registry
+
+    queries, requests = 0, 0
+    for (name, labels), histogram in list(registry.histograms.items()):
+        if name == "orders_request_queries" and dict(labels)["view"] == view:
+            queries += histogram.sum
+            requests += sum(histogram.counts)
+    return queries, requests
+
+
+def measure(view, func):
+    """Run the scenario and return its latencies, duration and queries per request."""
+    queries_before, requests_before = request_queries(view)
+    started_at = time.perf_counter()
+    latencies = func()
+    duration = time.perf_counter() - started_at
+    queries_after, requests_after = request_queries(view)
+    requests = requests_after - requests_before
+    return {
+        "throughput": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "queries": (queries_after - queries_before) / requests if requests else 0.0,
+    }
+
+
+def run_threads(threads, requests, func) -> list:
+    """Call func with the request numbers on the threads and return the latencies."""
+    from django.db import connection
+
+    latencies = []
+
+    def worker(index):
+        for number in range(index, requests, threads):
+            started_at = time.perf_counter()
+            func(number)
+            latencies.append(time.perf_counter() - started_at)
+        connection.close()
+
+    workers = [threading.Thread(target=worker, args=(index,)) for index in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies
+
+
+def post(client, path, data):
+    response = client.post(path, json.dumps(data), content_type="application/json")
+    assert response.status_code == 200, response.content
+    return response
+
+
+def create_session(args):
+    from django.test import Client
+
+    def create(number):
+        user_id = number % 10 + 1
+        post(Client(), "/orders/sessions/create/", {
+            "session_key": "key",
+            "user_id": user_id,
+            "location_id": user_id,
+            "name": "Burst {}".format(number),
+        })
+
+    return measure("create_session", lambda: run_threads(args.threads, args.sessions, create))
+
+
+def hot_sessions(args):
+    from django.test import Client
+    from orders.models import Session
+
+    sessions = [
+        Session.objects.create(code="h{:05d}".format(number), name="Hot {}".format(number), location_id=50).code
+        for number in range(args.hot_sessions)
+    ]
+
+    def add(number):
+        post(Client(), "/orders/products/add/", {
+            "session_code": sessions[number % len(sessions)],
+            "product_id": number % 20 + 1,
+        })
+
+    return measure("add_product_to_session", lambda: run_threads(args.threads, args.orders, add))
+
+
+def find_session(args):
+    from django.test import Client
+    from orders.models import Order, Session
+
+    sessions = Session.objects.bulk_create(
+        Session(code="f{:05d}".format(number), name="Large {}".format(number), location_id=99)
+        for number in range(args.location_sessions)
+    )
+    Order.objects.bulk_create(
+        Order(session=session, product_id=product_id)
+        for session in sessions for product_id in (1, 2, 3)
+    )
+
+    def page_through():
+        client = Client()
+        latencies = []
+        for _ in range(args.rounds):
+            cursor = ""
+            while True:
+                started_at = time.perf_counter()
+                response = client.get("/orders/sessions/find/", {"location_id": 99, "cursor": cursor})
+                latencies.append(time.perf_counter() - started_at)
+                assert response.status_code == 200, response.content
+                cursor = response.get("X-Next-Cursor")
+                if not cursor:
+                    break
+        return latencies
+
+    return measure("find_session", page_through)
+
+
+def ws_fanout(args):
+    from channels.db import database_sync_to_async
+    from channels.testing import WebsocketCommunicator
+    from django.test import Client
+
+    from orders.broadcast import dispatcher
+    from orders.models import Session
+    from orders.routing import application
+
+    session = Session.objects.create(code="w00001", name="Fan-out", location_id=60)
+
+    async def run():
+        dispatcher.bind(asyncio.get_event_loop())
+        communicators = []
+        for _ in range(args.subscribers):
+            communicator = WebsocketCommunicator(application, "/ws/session/{}/".format(session.code))
+            connected, _ = await communicator.connect()
+            assert connected
+            await communicator.receive_from()
+            communicators.append(communicator)
+
+        latencies = []
+
+        async def receive(communicator, sent_at):
+            await communicator.receive_from(timeout=30)
+            latencies.append(time.perf_counter() - sent_at)
+
+        client = Client()
+        for number in range(args.rounds * 10):
+            sent_at = time.perf_counter()
+            await database_sync_to_async(post)(client, "/orders/products/add/", {
+                "session_code": session.code,
+                "product_id": number + 1,
+            })
+            await asyncio.gather(*(receive(communicator, sent_at) for communicator in communicators))
+
+        for communicator in communicators:
+            await communicator.disconnect()
+        dispatcher.bind(None)
+        return latencies
+
+    return measure(
+        "add_product_to_session", lambda: asyncio.get_event_loop().run_until_complete(run())
+    )
+
+
+def warm_up():
+    """Load the URLs, views, serializers and the upstream client before the first measured request."""
+    from django.test import Client
+
+    Client().get("/orders/sessions/find/", {"location_id": 0})
+    post(Client(), "/orders/sessions/create/", {
+        "session_key": "key", "user_id": 1, "location_id": 1, "name": "Warm-up"
+    })
+
+
+SCENARIOS = {
+    "create_session": create_session,
+    "hot_sessions": hot_sessions,
+    "find_session": find_session,
+    "ws_fanout": ws_fanout,
+}
+
+
+def regressions(results, baseline, query_tolerance) -> list:
+    """Compare the queries per request with the baseline and describe the regressions."""
+    found = []
+    for scenario, result in results.items():
+        expected = baseline.get(scenario)
+        if expected is None:
+            continue
+        if result["queries"] > expected["queries"] * (1 + query_tolerance):
+            found.append("{} queries {:.2f} > {:.2f}".format(scenario, result["queries"], expected["queries"]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenarios", nargs="*", help="any of {} (default: all)".format(", ".join(SCENARIOS)))
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--sessions", type=int, default=200, help="sessions of create_session")
+    parser.add_argument("--hot-sessions", type=int, default=5, help="sessions of hot_sessions")
+    parser.add_argument("--orders", type=int, default=1000, help="orders of hot_sessions")
+    parser.add_argument("--location-sessions", type=int, default=2000, help="sessions of find_session")
+    parser.add_argument("--subscribers", type=int, default=200, help="sockets of ws_fanout")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--delay", type=float, default=0.005, help="stub latency in seconds")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--query-tolerance", type=float, default=0.1, help="allowed relative query regression")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error("unknown scenarios: {}".format(", ".join(sorted(unknown))))
+
+    setup()
+    use_stubs(start_stubs(delay=args.delay))
+    warm_up()
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results[name] = SCENARIOS[name](args)
+        report(name, [
+            ("throughput [requests/s]", results[name]["throughput"]),
+            ("latency p50 [ms]", results[name]["p50_ms"]),
+            ("latency p99 [ms]", results[name]["p99_ms"]),
+            ("queries per request", results[name]["queries"]),
+        ])
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump({
+                "parameters": {name: getattr(args, name) for name in PARAMETERS},
+                "scenarios": {name: {"queries": result["queries"]} for name, result in results.items()},
+            }, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("Saved the baseline to {}.".format(args.baseline))
+        return
+
+    if not os.path.exists(args.baseline):
+        return
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    mismatched = [
+        "--{} {} (baseline: {})".format(name.replace("_", "-"), getattr(args, name), value)
+        for name, value in sorted(baseline["parameters"].items()) if getattr(args, name) != value
+    ]
+    if mismatched:
+        print("Not compared with {}, the run parameters differ: {}".format(args.baseline, ", ".join(mismatched)))
+        sys.exit(2)
+    found = regressions(results, baseline["scenarios"], args.query_tolerance)
+    if found:
+        print("Regressions against {}:".format(args.baseline))
+        for regression in found:
+            print("  {}".format(regression))
+        sys.exit(1)
+    print("No regressions against {}.".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Measure the latency of `create_session` against local stub services.
+
+The serial baseline sends the three upstream requests one after another
+on fresh connections, like `create_session` did before the upstream client.
+"""
+import argparse
+import json
+import time
+
+import requests
+
+from . import percentile, report, setup
+from .stubs import start_stubs, use_stubs
+
+
+def serial_baseline(url, location_id):
+    requests.post(
+        "{}/verification/verify/".format(url),
+        data=json.dumps({"session_key": "key", "user_id": location_id})
+    )
+    requests.get("{}/locations/get/{}/".format(url, location_id))
+    requests.get("{}/codes/new/".format(url))
+
+
+def measure(func, iterations):
+    latencies = []
+    for iteration in range(iterations):
+        started_at = time.perf_counter()
+        func(iteration)
+        latencies.append(time.perf_counter() - started_at)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--delay", type=float, default=0.01, help="stub latency in seconds")
+    args = parser.parse_args()
+
+    setup()
+    url = start_stubs(delay=args.delay)
+    use_stubs(url)
+
+    from django.test import Client
+    client = Client()
+
+    def create_session(iteration):
+        response = client.post("/orders/sessions/create/", json.dumps({
+            "session_key": "key",
+            "user_id": 1,
+            "location_id": 1,
+            "name": "Table {}".format(iteration),
+        }), content_type="application/json")
+        assert response.status_code == 200, response.content
+
+    results = {
+        "serial baseline": measure(lambda _: serial_baseline(url, 1), args.iterations),
+        "create_session": measure(create_session, args.iterations),
+    }
+
+    rows = []
+    for label, latencies in results.items():
+        rows.append(("{} p50 [ms]".format(label), percentile(latencies, 50) * 1000))
+        rows.append(("{} p99 [ms]".format(label), percentile(latencies, 99) * 1000))
+    report("upstream latency ({} iterations, {:.0f} ms stub delay)".format(
+        args.iterations, args.delay * 1000
+    ), rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+
+
+class OrdersConfig(AppConfig):
+    name = "orders"
+
+    def ready(self):
+        from django.core.signals import request_started
+
+        # connect the database hooks
+        from . import databases  # noqa: F401
+        from .archive import start_scheduler
+        from .ingestion import start_flusher
+
+        # the background threads are started with the first request of every worker process
+        request_started.connect(start_scheduler, dispatch_uid="session_archiver_start_scheduler")
+        request_started.connect(start_flusher, dispatch_uid="order_log_start_flusher")
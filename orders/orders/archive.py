@@ -0,0 +1,117 @@
+"""
+Archival of closed sessions.
+
+Closed sessions, which are older than `ARCHIVE_AFTER_DAYS`, are moved
+together with their orders and product tallies out of the hot tables into
+the archive table. Each archived session is stored as its encoded payload,
+so that the archive is read without touching the session and order tables.
+
+With `ARCHIVE_INTERVAL`, one process archives sessions in the background.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from . import encoding, metrics
+from .background import BackgroundThread
+from .ingestion import locked
+from .models import ArchivedSession, Session, SessionState
+from .serializers import serialize_sessions
+from .snapshots import snapshot_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class SessionArchiver:
+
+    def __init__(self):
+        self._thread = BackgroundThread(self._run, "session-archiver")
+
+        self.archived = 0
+        self.batches = 0
+        self.last_run = None
+
+    def archivable(self, cutoff):
+        return Session.objects.filter(state=SessionState.CLOSED.value, timestamp__lt=cutoff)
+
+    def archive_batch(self, cutoff) -> int:
+        """Archive the next batch of sessions created before the cutoff and return their number."""
+        with transaction.atomic():
+            codes = list(
+                self.archivable(cutoff)
+                .select_for_update()
+                .order_by("timestamp")
+                .values_list("code", flat=True)[:settings.ARCHIVE_BATCH_SIZE]
+            )
+            if not codes:
+                return 0
+
+            sessions = serialize_sessions(Session.objects.filter(code__in=codes))
+            ArchivedSession.objects.bulk_create(
+                ArchivedSession(
+                    code=session["code"],
+                    location_id=session["location_id"],
+                    timestamp=session["timestamp"],
+                    payload=encoding.dumps(session).decode(),
+                )
+                for session in sessions
+            )
+            # orders and product tallies are deleted with their sessions
+            Session.objects.filter(code__in=codes).delete()
+            for code in codes:
+                transaction.on_commit(lambda code=code: snapshot_cache.invalidate(code))
+
+        self.archived += len(codes)
+        self.batches += 1
+        return len(codes)
+
+    def archive(self, days=None) -> int:
+        """Archive all closed sessions older than the given days and return their number."""
+        cutoff = timezone.now() - timedelta(days=settings.ARCHIVE_AFTER_DAYS if days is None else days)
+        archived = 0
+        while True:
+            batch = self.archive_batch(cutoff)
+            if not batch:
+                self.last_run = timezone.now()
+                return archived
+            archived += batch
+
+    def ensure_scheduler(self):
+        """Start the background archiver of this process, if it is not running."""
+        self._thread.ensure_started()
+
+    def stats(self) -> dict:
+        return {
+            "archived": self.archived,
+            "batches": self.batches,
+            "last_run": self.last_run.isoformat() if self.last_run else None,
+        }
+
+    def _run(self):
+        while True:
+            try:
+                with locked(settings.ARCHIVE_LOCK, blocking=False):
+                    self.archive()
+            except BlockingIOError:
+                # another process archives the sessions
+                pass
+            except Exception:
+                logger.exception("Archiving sessions failed.")
+            finally:
+                connection.close()
+            time.sleep(settings.ARCHIVE_INTERVAL)
+
+
+archiver = SessionArchiver()
+
+metrics.register("archive", archiver.stats)
+
+
+def start_scheduler(**kwargs):
+    if settings.ARCHIVE_INTERVAL > 0:
+        archiver.ensure_scheduler()
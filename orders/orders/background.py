@@ -0,0 +1,31 @@
+"""
+Background threads of the worker processes.
+
+Threads do not survive forking worker processes, so a background thread
+is started again in every process, which needs it.
+"""
+import os
+import threading
+
+
+class BackgroundThread:
+    """Daemon thread, which runs at most once per process."""
+
+    def __init__(self, target, name):
+        self.target = target
+        self.name = name
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        """Start the thread in this process, if it is not running."""
+        with self._lock:
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self._thread.start()
+
+    def is_current(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
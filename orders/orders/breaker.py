@@ -0,0 +1,94 @@
+"""
+Circuit breakers for the upstream services.
+
+A breaker opens after `CIRCUIT_BREAKER_FAILURE_THRESHOLD` consecutive failures,
+where calls slower than the latency budget of the service count as failures.
+While it is open, calls fail immediately. After `CIRCUIT_BREAKER_RESET_TIMEOUT`
+seconds, it is half-open and lets one trial call through, which either closes
+or reopens the breaker.
+"""
+import threading
+import time
+from enum import Enum
+
+from django.conf import settings
+
+
+class BreakerState(Enum):
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+
+    def __init__(self, name, latency_budget_setting):
+        self.name = name
+        self.latency_budget_setting = latency_budget_setting
+        self._lock = threading.Lock()
+
+        self.state = BreakerState.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.trial_thread = None
+
+        self.rejected = 0
+        self.times_opened = 0
+
+    @property
+    def latency_budget(self) -> float:
+        return getattr(settings, self.latency_budget_setting)
+
+    def allow(self) -> bool:
+        """Check if a call may be made, and count it as rejected otherwise."""
+        with self._lock:
+            if self.state == BreakerState.OPEN:
+                if time.monotonic() - self.opened_at < settings.CIRCUIT_BREAKER_RESET_TIMEOUT:
+                    self.rejected += 1
+                    return False
+                self.state = BreakerState.HALF_OPEN
+
+            if self.state == BreakerState.HALF_OPEN:
+                if self.trial_running:
+                    self.rejected += 1
+                    return False
+                self.trial_running = True
+                self.trial_thread = threading.get_ident()
+
+            return True
+
+    def record_success(self, latency: float):
+        if latency > self.latency_budget:
+            self.record_failure()
+            return
+        with self._lock:
+            self.state = BreakerState.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == BreakerState.HALF_OPEN \
+                    or self.failures >= settings.CIRCUIT_BREAKER_FAILURE_THRESHOLD:
+                if self.state != BreakerState.OPEN:
+                    self.times_opened += 1
+                self.state = BreakerState.OPEN
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """Free the trial call of the current thread, if it ended without a success or failure."""
+        with self._lock:
+            if self.trial_running and self.trial_thread == threading.get_ident():
+                self.trial_running = False
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "state": self.state.value,
+                "failures": self.failures,
+                "rejected": self.rejected,
+                "times_opened": self.times_opened,
+            }
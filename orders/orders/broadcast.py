@@ -0,0 +1,165 @@
+"""
+Background dispatch of session broadcasts.
+
+Broadcasts are queued, after the transaction which caused them commits,
+and sent by a background thread. All messages for the same groups, which
+arrive within the coalescing window, are sent as one channel layer message.
+The messages are encoded once, and the consumers forward the encoded frames.
+"""
+import asyncio
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections
+
+from . import encoding, instrumentation, metrics
+from .background import BackgroundThread
+
+
+logger = logging.getLogger(__name__)
+
+
+def coalesce(messages):
+    """
+    Coalesce the queued messages of a group.
+
+    Messages are either event dicts, snapshot dicts or callables, which
+    build a snapshot. A snapshot supersedes all messages queued before it,
+    and all events it already contains. Nothing is sent for deleted sessions.
+    """
+    for index in reversed(range(len(messages))):
+        if callable(messages[index]) or "session" in messages[index]:
+            snapshot = messages[index]() if callable(messages[index]) else messages[index]
+            if snapshot is None:
+                return []
+            # the snapshot already contains the events, which were committed before it was built
+            sequence = snapshot["session"]["sequence"]
+            return [snapshot] + sorted(
+                (message for message in messages[index + 1:] if message["sequence"] > sequence),
+                key=lambda message: message["sequence"]
+            )
+    # events of concurrent transactions may be committed out of order
+    return sorted(messages, key=lambda message: message["sequence"])
+
+
+def describe(message) -> list:
+    """Get the `[session_code, state]` of an event or snapshot message."""
+    if "session" in message:
+        return [message["session"]["code"], message["session"]["state"]]
+    return [message["session_code"], message["state"]]
+
+
+class BroadcastDispatcher:
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = OrderedDict()
+        self._thread = BackgroundThread(self._run, "broadcast-dispatcher")
+        self._loop = None
+        self._bound_loop = None
+
+        self.enqueued = 0
+        self.dispatched = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.max_queue_depth = 0
+
+    @property
+    def queue_depth(self):
+        return sum(len(messages) for messages in self._pending.values())
+
+    def enqueue(self, group_names, message):
+        """Queue a message for a tuple of groups and wake up the dispatcher thread."""
+        with self._condition:
+            self._pending.setdefault(group_names, []).append(message)
+            self.enqueued += 1
+            self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+            self._thread.ensure_started()
+            self._condition.notify()
+
+    def bind(self, loop):
+        """
+        Send all messages on the given event loop.
+
+        In-process channel layers, like the in-memory layer, only deliver
+        messages to consumers, which run on the loop the message is sent from.
+        """
+        self._bound_loop = loop
+
+    def flush(self):
+        """Send all queued messages immediately."""
+        with self._condition:
+            pending, self._pending = self._pending, OrderedDict()
+        for group_names, messages in pending.items():
+            self._dispatch(group_names, messages)
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "queue_depth": self.queue_depth,
+                "max_queue_depth": self.max_queue_depth,
+                "pending_groups": len(self._pending),
+                "enqueued": self.enqueued,
+                "dispatched": self.dispatched,
+                "coalesced": self.coalesced,
+                "failed": self.failed,
+            }
+
+    def _run(self):
+        # a long-living loop keeps the channel layer connections open
+        self._loop = asyncio.new_event_loop()
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+            # give further updates to the same groups the chance to arrive
+            time.sleep(settings.BROADCAST_COALESCE_WINDOW)
+            self.flush()
+
+    @instrumentation.timed("orders_broadcast_duration_seconds")
+    def _dispatch(self, group_names, messages):
+        queued = len(messages)
+        try:
+            messages = coalesce(messages)
+            if not messages:
+                return
+            # consumers, which filter by session or state, do not need to decode the frames
+            message = {
+                "type": "session_update",
+                "frames": [encoding.dumps(message).decode() for message in messages],
+                "sessions": [describe(message) for message in messages],
+            }
+            for group_name in group_names:
+                # the group type, e.g. "session" of "session_587944"
+                with instrumentation.timer("orders_channel_layer_send_seconds", group=group_name.split("_")[0]):
+                    self._send(group_name, message)
+        except Exception:
+            logger.exception("Broadcast to %s failed.", ", ".join(group_names))
+            self.failed += 1
+        else:
+            self.dispatched += 1
+            # the queued messages, which were superseded by a later snapshot
+            self.coalesced += queued - len(messages)
+        finally:
+            close_old_connections()
+
+    def _send(self, group_name, message):
+        channel_layer = get_channel_layer()
+        if self._bound_loop is not None:
+            asyncio.run_coroutine_threadsafe(
+                channel_layer.group_send(group_name, message), self._bound_loop
+            ).result()
+        elif self._thread.is_current():
+            self._loop.run_until_complete(channel_layer.group_send(group_name, message))
+        else:
+            async_to_sync(channel_layer.group_send)(group_name, message)
+
+
+dispatcher = BroadcastDispatcher()
+
+metrics.register("broadcast", dispatcher.stats)
@@ -0,0 +1,168 @@
+"""
+Caches for the results of the verification and locations services.
+
+Verifications are cached by `(session_key, user_id)` and location owners
+by `location_id`. Failed lookups are cached as well, but for a shorter time.
+Errors of the services themselves, like server errors or rate limits, are
+never cached. The local cache belongs to one process, so its entries can only
+be invalidated by the process itself; deployments with several workers use
+the django backend, if they invalidate entries.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+from . import metrics
+
+
+MISSING = object()
+
+
+class LocalCache:
+    """In-process LRU cache with a TTL per entry."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at = self._entries[key]
+            except KeyError:
+                return default
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoCache:
+    """Cache on top of a django cache backend, which may be shared between processes."""
+
+    def __init__(self, alias):
+        self.cache = caches[alias]
+
+    def get(self, key, default=None):
+        return self.cache.get(key, default)
+
+    def set(self, key, value, ttl):
+        self.cache.set(key, value, ttl)
+
+    def delete(self, key):
+        self.cache.delete(key)
+
+    def clear(self):
+        # other entries of the shared backend must survive
+        pass
+
+
+BACKENDS = {
+    "local": lambda: LocalCache(settings.UPSTREAM_CACHE_MAX_SIZE),
+    "django": lambda: DjangoCache(settings.UPSTREAM_CACHE_ALIAS),
+}
+
+
+class LookupCache:
+    """Cache for the results of an upstream lookup, which counts its hits and misses."""
+
+    def __init__(self, name):
+        self.name = name
+        self._backend = None
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = BACKENDS[settings.UPSTREAM_CACHE]()
+        return self._backend
+
+    def make_key(self, *parts) -> str:
+        # keys must be valid for every django cache backend and must not leak session keys
+        digest = hashlib.sha256("\0".join(str(part) for part in parts).encode()).hexdigest()
+        return "orders:{}:{}".format(self.name, digest)
+
+    def lookup(self, parts: tuple, func):
+        """
+        Get the cached result for the key parts or call the function.
+
+        Falsy results are cached for `UPSTREAM_CACHE_NEGATIVE_TTL` seconds.
+        """
+        key = self.make_key(*parts)
+        value = self.backend.get(key, MISSING)
+        if value is not MISSING:
+            if value:
+                self.hits += 1
+            else:
+                self.negative_hits += 1
+            return value
+
+        self.misses += 1
+        value = func()
+        ttl = settings.UPSTREAM_CACHE_TTL if value else settings.UPSTREAM_CACHE_NEGATIVE_TTL
+        if ttl > 0:
+            self.backend.set(key, value, ttl)
+        return value
+
+    def invalidate(self, *parts):
+        self.backend.delete(self.make_key(*parts))
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+        }
+
+
+verifications = LookupCache("verification")
+location_owners = LookupCache("location_owner")
+
+
+def invalidate_user(session_key, user_id):
+    """Forget the cached verification of a user."""
+    verifications.invalidate(session_key, user_id)
+
+
+def invalidate_location(location_id):
+    """Forget the cached owner of a location."""
+    location_owners.invalidate(location_id)
+
+
+def clear():
+    """Forget all cached lookups of this process."""
+    verifications.clear()
+    location_owners.clear()
+
+
+metrics.register("cache", lambda: {
+    "verification": verifications.stats(),
+    "location_owner": location_owners.stats(),
+})
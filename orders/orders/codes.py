@@ -0,0 +1,191 @@
+"""
+Pool of codes, which are fetched from the codes service ahead of time.
+
+The pool is stored in the database, so that it is shared by all workers
+and can be warmed before they start. Whenever it drops below the low-water
+mark, it is refilled in the background, in batches of concurrent requests.
+Every code is claimed atomically, so that concurrent workers never take
+the same code. Only SQLite before 3.35 retries, if another worker was faster.
+"""
+import logging
+import threading
+from concurrent.futures import Future, wait
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from . import instrumentation, metrics, upstream
+from .models import ReservedCode
+
+
+logger = logging.getLogger(__name__)
+
+
+@instrumentation.timed("orders_upstream_duration_seconds", service="codes")
+def fetch_code() -> str:
+    """Fetch a new code from the codes service."""
+    response = upstream.get("codes", "/codes/new/")
+
+    if response.status_code != 200:
+        raise ValueError()
+
+    code_data = response.json()
+
+    try:
+        return code_data["value"]
+    except KeyError:
+        raise ValueError()
+
+
+class CodePool:
+
+    def __init__(self):
+        self._refill_lock = threading.Lock()
+        self._refilling = False
+        # codes in the pool at the last refill, minus the codes taken since by this worker
+        self._remaining = None
+
+        self.taken = 0
+        self.fallbacks = 0
+        self.refilled = 0
+        self.returned = 0
+
+    def take(self) -> Future:
+        """
+        Take a code from the pool.
+
+        If the pool is empty, the code is fetched in the background,
+        unless the `CODE_POOL_FALLBACK` is "fail". The future then
+        raises `ServiceUnavailable`.
+        """
+        if settings.CODE_POOL_SIZE <= 0:
+            return upstream.submit(fetch_code)
+
+        code = self._pop()
+        # instead of counting the pool on every request, the low-water mark is checked
+        # with the estimate, and an empty pool always triggers a refill
+        if code is None or self._below_low_water():
+            self.refill_in_background()
+
+        if code is not None:
+            self.taken += 1
+            future = Future()
+            future.set_result(code)
+            return future
+
+        self.fallbacks += 1
+        if settings.CODE_POOL_FALLBACK == "fetch":
+            return upstream.submit(fetch_code)
+
+        future = Future()
+        future.set_exception(upstream.ServiceUnavailable("codes"))
+        return future
+
+    def give_back(self, future: Future):
+        """Put the code of an unused future back into the pool, if the code was already fetched."""
+        if settings.CODE_POOL_SIZE <= 0 or not future.done() or future.exception() is not None:
+            return
+        ReservedCode.objects.bulk_create([ReservedCode(code=future.result())], ignore_conflicts=True)
+        self.returned += 1
+
+    def size(self) -> int:
+        return ReservedCode.objects.count()
+
+    def refill(self) -> int:
+        """Fill the pool up to `CODE_POOL_SIZE` codes and return the number of added codes."""
+        size = self.size()
+        missing = settings.CODE_POOL_SIZE - size
+        if missing <= 0:
+            self._remaining = size
+            return 0
+
+        futures = [upstream.submit(fetch_code) for _ in range(missing)]
+        wait(futures)
+        codes = {
+            future.result() for future in futures if future.exception() is None
+        }
+        # codes, which are already in the pool, are ignored
+        ReservedCode.objects.bulk_create(
+            [ReservedCode(code=code) for code in codes], ignore_conflicts=True
+        )
+        self._remaining = size + len(codes)
+        self.refilled += len(codes)
+        return len(codes)
+
+    def refill_in_background(self):
+        with self._refill_lock:
+            if self._refilling:
+                return
+            self._refilling = True
+        threading.Thread(target=self._refill, name="code-pool-refill", daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            "taken": self.taken,
+            "fallbacks": self.fallbacks,
+            "refilled": self.refilled,
+            "returned": self.returned,
+        }
+
+    def _below_low_water(self) -> bool:
+        with self._refill_lock:
+            if self._remaining is None:
+                return True
+            self._remaining -= 1
+            return self._remaining < settings.CODE_POOL_LOW_WATER
+
+    def _pop(self):
+        """Claim the oldest code of the pool, or return None if it is empty."""
+        if connection.features.has_select_for_update_skip_locked:
+            # codes, which are claimed by other workers, are skipped instead of waited for
+            with transaction.atomic():
+                code = ReservedCode.objects \
+                    .select_for_update(skip_locked=True) \
+                    .order_by("timestamp") \
+                    .values_list("code", flat=True) \
+                    .first()
+                if code is not None:
+                    ReservedCode.objects.filter(pk=code).delete()
+                return code
+
+        if connection.vendor == "sqlite" and connection.Database.sqlite_version_info >= (3, 35):
+            # SQLite serializes its writes, so one DELETE ... RETURNING claims the code
+            quote_name = connection.ops.quote_name
+            sql = "DELETE FROM {table} WHERE {code} = (SELECT {code} FROM {table} ORDER BY {timestamp} LIMIT 1) " \
+                  "RETURNING {code}".format(
+                      table=quote_name(ReservedCode._meta.db_table),
+                      code=quote_name("code"),
+                      timestamp=quote_name("timestamp"),
+                  )
+            with connection.cursor() as cursor:
+                cursor.execute(sql)
+                row = cursor.fetchone()
+            return row[0] if row else None
+
+        # another worker may claim the same code in the meantime, so retry with the next one
+        for _ in range(3):
+            code = ReservedCode.objects \
+                .order_by("timestamp") \
+                .values_list("code", flat=True) \
+                .first()
+            if code is None:
+                return None
+            deleted, _ = ReservedCode.objects.filter(pk=code).delete()
+            if deleted:
+                return code
+        return None
+
+    def _refill(self):
+        try:
+            self.refill()
+        except Exception:
+            logger.exception("Refilling the code pool failed.")
+        finally:
+            connection.close()
+            with self._refill_lock:
+                self._refilling = False
+
+
+pool = CodePool()
+
+metrics.register("code_pool", pool.stats)
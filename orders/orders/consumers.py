@@ -1,49 +1,365 @@
+import asyncio
+import functools
 import json
+import time
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from json import JSONDecodeError
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
+from channels.generic.websocket import AsyncWebsocketConsumer
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import close_old_connections
 
-from .models import Session
+from . import encoding, instrumentation, metrics
+from .databases import check_connections
+from .models import Session, SessionState, location_group_name
+from .serializers import serialize_sessions
+from .snapshots import snapshot_cache
 
 
-class SessionConsumer(WebsocketConsumer):
+# bounded pool for the blocking ORM calls of all consumers in this process,
+# so that idle sockets do not hold any threads
+database_executor = ThreadPoolExecutor(
+    max_workers=settings.CONSUMER_DATABASE_THREADS,
+    thread_name_prefix="consumer-database",
+)
 
-    def connect(self):
+
+def _call_with_fresh_connection(func):
+    close_old_connections()
+    check_connections()
+    try:
+        return func()
+    finally:
+        close_old_connections()
+
+
+async def run_in_database_executor(func, *args, **kwargs):
+    """Run a blocking database call on the bounded consumer executor."""
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        database_executor,
+        _call_with_fresh_connection,
+        functools.partial(func, *args, **kwargs)
+    )
+
+
+def load_session(session_code):
+    """Load a session together with its encoded snapshot."""
+    session = Session.objects.get(code__exact=session_code)
+    _, snapshot = snapshot_cache.get(session.code, session.sequence)
+    return session, snapshot
+
+
+def load_location_sessions(location_id, states):
+    """Load the `{code: state}` and the encoded sessions of a location, which are in the states."""
+    sessions = serialize_sessions(
+        Session.objects.filter(location_id=location_id, state__in=states).order_by("timestamp")
+    )
+    return (
+        {session["code"]: session["state"] for session in sessions},
+        encoding.dumps({"sessions": sessions})
+    )
+
+
+def parse_message(text_data):
+    """Parse a client message into a dict with an action, or return None."""
+    try:
+        message = json.loads(text_data)
+    except (TypeError, JSONDecodeError):
+        return None
+    if not isinstance(message, dict) or not isinstance(message.get("action"), str):
+        return None
+    return message
+
+
+# close code for clients, which are too slow to receive their updates
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class FanoutStats:
+
+    def __init__(self):
+        self.consumers = weakref.WeakSet()
+        self.overflows = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.disconnected = 0
+
+    def stats(self) -> dict:
+        buffered = [consumer.outbox.qsize() for consumer in list(self.consumers)]
+        return {
+            "connections": len(buffered),
+            "buffered": sum(buffered),
+            "max_buffered": max(buffered, default=0),
+            "overflows": self.overflows,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "disconnected": self.disconnected,
+            "channel_layer": channel_layer_usage(),
+        }
+
+
+def channel_layer_usage() -> dict:
+    """Get the usage of the channel layer by the channels of this process."""
+    layer = get_channel_layer()
+    # the in-memory layer holds all channels, the redis layer buffers the ones of this process
+    queues = getattr(layer, "receive_buffer", None) or getattr(layer, "channels", {})
+    sizes = [queue.qsize() for queue in list(queues.values())]
+    return {
+        "backend": type(layer).__name__,
+        "capacity": layer.capacity,
+        "channels": len(sizes),
+        "queued": sum(sizes),
+        "max_queued": max(sizes, default=0),
+    }
+
+
+fanout = FanoutStats()
+
+metrics.register("consumers", fanout.stats)
+
+
+class BufferedConsumer(AsyncWebsocketConsumer):
+    """
+    Websocket consumer, which sends its frames from a bounded buffer.
+
+    Channel layer messages are handled without waiting for the client, so
+    that slow clients do not fill up the channel layer. When the buffer of a
+    client overflows, the buffered frames are replaced by a resync, and
+    clients, which overflow too often, are disconnected.
+    """
+    outbox = None
+    sender = None
+    # label of the instrumentation
+    group_type = None
+
+    def start_sender(self):
+        self.outbox = asyncio.Queue(maxsize=settings.CONSUMER_SEND_BUFFER)
+        self.overflows = deque()
+        self.resync_pending = False
+        self.sender = asyncio.ensure_future(self.send_frames())
+        fanout.consumers.add(self)
+        instrumentation.add("orders_websocket_connections", 1, group=self.group_type)
+
+    def stop_sender(self):
+        if self.sender is not None:
+            self.sender.cancel()
+            self.sender = None
+            fanout.consumers.discard(self)
+            instrumentation.add("orders_websocket_connections", -1, group=self.group_type)
+
+    async def send_frames(self):
+        while True:
+            frame = await self.outbox.get()
+            if frame is None:
+                self.resync_pending = False
+                frame = await self.resync_frame()
+            started_at = time.perf_counter()
+            await self.send(text_data=frame)
+            instrumentation.observe(
+                "orders_websocket_send_seconds", time.perf_counter() - started_at, group=self.group_type
+            )
+
+    async def resync_frame(self) -> str:
+        """Build the frame, which replaces the frames dropped on an overflow."""
+        raise NotImplementedError()
+
+    async def buffer_frame(self, frame):
+        """Queue a frame for the client, without waiting for the client."""
+        if self.sender is None:
+            return
+        # the pending resync will contain the update
+        if self.resync_pending:
+            fanout.coalesced += 1
+            return
+        try:
+            self.outbox.put_nowait(frame)
+            return
+        except asyncio.QueueFull:
+            pass
+
+        fanout.overflows += 1
+        fanout.dropped += self.outbox.qsize() + 1
+        while not self.outbox.empty():
+            self.outbox.get_nowait()
+
+        now = time.monotonic()
+        self.overflows.append(now)
+        while self.overflows[0] < now - settings.CONSUMER_OVERFLOW_WINDOW:
+            self.overflows.popleft()
+        if len(self.overflows) > settings.CONSUMER_MAX_OVERFLOWS:
+            fanout.disconnected += 1
+            self.stop_sender()
+            await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+            return
+
+        self.resync_pending = True
+        self.outbox.put_nowait(None)
+
+
+class SessionConsumer(BufferedConsumer):
+    session = None
+    group_type = "session"
+
+    async def connect(self):
         self.session_code = self.scope["url_route"]["kwargs"]["session_code"]
 
         # reject all connections to erroneous session codes
         try:
-            self.session = Session.objects.get(code__exact=self.session_code)
+            self.session, snapshot = await run_in_database_executor(
+                load_session, self.session_code
+            )
         except Session.DoesNotExist:
-            self.close(code=404)
+            await self.close(code=404)
             return
 
         # join session group
-        async_to_sync(self.channel_layer.group_add)(
+        await self.channel_layer.group_add(
             self.session.group_name, self.channel_name
         )
 
-        self.accept()
+        await self.accept()
 
-        self.send(text_data=json.dumps(self.session.dict_representation))
+        await self.send(text_data=snapshot.decode())
+        self.start_sender()
 
-    def disconnect(self, code):
+    async def disconnect(self, code):
+        self.stop_sender()
         # if no session was found, the session attribute will be None
         if self.session:
-            async_to_sync(self.channel_layer.group_discard)(
+            await self.channel_layer.group_discard(
                 self.session.group_name, self.channel_name
             )
 
-    def session_update(self, event):
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Called when the client sends a message.
+
+        Clients request a full resync of the session,
+        when they detect a gap in the event sequence numbers.
+        """
+        message = parse_message(text_data)
+        if message is None or message["action"] != "resync":
+            return
+
+        await self.buffer_frame(await self.resync_frame())
+
+    async def resync_frame(self) -> str:
+        self.session, snapshot = await run_in_database_executor(
+            load_session, self.session_code
+        )
+        return '{{"session": {}}}'.format(snapshot.decode())
+
+    async def session_update(self, event):
         """
         Called when the session updates.
 
         A session updates, when its state changes
         or when orders are placed.
         """
-        session = event["session"]
+        # forward the encoded messages to websocket
+        for frame in event["frames"]:
+            await self.buffer_frame(frame)
+
+
+class LocationConsumer(BufferedConsumer):
+    """
+    Multiplexes the updates of all sessions at a location over one socket.
+
+    Clients receive the sessions in the subscribed states (initially: open),
+    and the updates of these sessions. A session, which leaves the subscribed
+    states, is updated one last time, so that clients can drop it.
+    """
+    joined = False
+    group_type = "location"
+
+    async def connect(self):
+        self.location_id = int(self.scope["url_route"]["kwargs"]["location_id"])
+        self.states = {SessionState.OPEN.value}
+        # {code: state} of the sessions, which the client knows
+        self.sessions = {}
+
+        await self.channel_layer.group_add(
+            location_group_name(self.location_id), self.channel_name
+        )
+        self.joined = True
+
+        await self.accept()
+
+        await self.send(text_data=await self.load_sessions(self.states))
+        self.start_sender()
+
+    async def disconnect(self, code):
+        self.stop_sender()
+        if self.joined:
+            await self.channel_layer.group_discard(
+                location_group_name(self.location_id), self.channel_name
+            )
+
+    async def load_sessions(self, states) -> str:
+        sessions, encoded = await run_in_database_executor(
+            load_location_sessions, self.location_id, states
+        )
+        self.sessions.update(sessions)
+        return encoded.decode()
+
+    async def resync_frame(self) -> str:
+        return await self.load_sessions(self.states)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """
+        Called when the client sends a message.
+
+        Clients subscribe to or unsubscribe from session states with
+        `{"action": "subscribe" | "unsubscribe", "states": [...]}`, and
+        request a resync of all sessions or of one session with
+        `{"action": "resync", "session_code": ...}`.
+        """
+        message = parse_message(text_data)
+        if message is None:
+            return
+
+        if message["action"] == "resync":
+            await self.resync(message.get("session_code"))
+            return
+
+        states = message.get("states")
+        valid_states = {state.value for state in SessionState}
+        if not isinstance(states, list) or not set(states) <= valid_states:
+            return
+
+        if message["action"] == "subscribe":
+            added = set(states) - self.states
+            self.states |= added
+            if added:
+                await self.buffer_frame(await self.load_sessions(added))
+        elif message["action"] == "unsubscribe":
+            self.states -= set(states)
+            self.sessions = {
+                code: state for code, state in self.sessions.items() if state in self.states
+            }
+
+    async def resync(self, session_code):
+        if session_code is None:
+            await self.buffer_frame(await self.resync_frame())
+            return
+
+        try:
+            session, snapshot = await run_in_database_executor(load_session, session_code)
+        except Session.DoesNotExist:
+            return
+        if session.location_id != self.location_id:
+            return
+        await self.buffer_frame('{{"session": {}}}'.format(snapshot.decode()))
 
-        # forward message to websocket
-        self.send(text_data=json.dumps({
-            "session": session
-        }))
+    async def session_update(self, event):
+        """Called when a session of the location updates."""
+        for (code, state), frame in zip(event["sessions"], event["frames"]):
+            if state in self.states:
+                self.sessions[code] = state
+            elif self.sessions.pop(code, None) is None:
+                continue
+            await self.buffer_frame(frame)
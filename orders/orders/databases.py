@@ -0,0 +1,36 @@
+"""
+Hooks for the connections of the database profiles.
+
+SQLite connections get the `PRAGMAS` of their profile, when they are created.
+Persistent connections with `CONN_HEALTH_CHECKS` are checked once per request,
+before they are reused, so that a connection closed by the database server
+does not fail the request.
+"""
+from django.core.signals import request_started
+from django.db import DatabaseError, connections
+from django.db.backends.signals import connection_created
+
+
+def apply_pragmas(sender, connection, **kwargs):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for pragma, value in connection.settings_dict.get("PRAGMAS", {}).items():
+            cursor.execute("PRAGMA {} = {}".format(pragma, value))
+
+
+def check_connections(**kwargs):
+    """Close the persistent connections, which are no longer usable."""
+    for connection in connections.all():
+        if connection.connection is None or not connection.settings_dict.get("CONN_HEALTH_CHECKS"):
+            continue
+        if connection.is_usable():
+            continue
+        try:
+            connection.close()
+        except DatabaseError:
+            connection.connection = None
+
+
+connection_created.connect(apply_pragmas, dispatch_uid="databases_apply_pragmas")
+request_started.connect(check_connections, dispatch_uid="databases_check_connections")
@@ -0,0 +1,48 @@
+"""
+JSON encoding of responses, snapshots and broadcasts.
+
+With the `JSON_ENCODER` setting "auto", orjson is used if it is installed,
+otherwise the standard library. Both encode datetimes in ISO 8601 format,
+so that they do not need to be converted beforehand.
+"""
+import json
+from datetime import date, datetime
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(value).__name__))
+
+
+def dumps_stdlib(data) -> bytes:
+    return json.dumps(data, default=_default).encode()
+
+
+def dumps_orjson(data) -> bytes:
+    return orjson.dumps(data)
+
+
+ENCODERS = {
+    "json": dumps_stdlib,
+    "orjson": dumps_orjson,
+}
+
+
+def get_encoder():
+    """Get the encoding function, which is selected by the `JSON_ENCODER` setting."""
+    if settings.JSON_ENCODER == "auto":
+        return dumps_stdlib if orjson is None else dumps_orjson
+    return ENCODERS[settings.JSON_ENCODER]
+
+
+def dumps(data) -> bytes:
+    """Encode the data to JSON bytes."""
+    return get_encoder()(data)
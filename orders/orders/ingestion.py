@@ -0,0 +1,273 @@
+"""
+Write-behind ingestion of orders.
+
+In the buffered ingestion mode, orders are acknowledged as soon as they are
+appended to a local log and synced to disk. A background flusher inserts them
+into the database in batches, in the order of the log, and stores its position
+in the log in the same transaction. After a restart, the flusher continues from
+this position, so that no acknowledged order is lost or inserted twice.
+
+Only one process flushes the log at a time. Once the log is fully flushed,
+it is replaced by an empty one.
+
+Orders are only appended for open sessions, and a session is closed while
+no order can be appended, after the log was flushed. So every acknowledged
+order is inserted before its session is closed.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import metrics
+from .background import BackgroundThread
+from .models import (
+    IngestionCheckpoint, Order, Session, SessionState, close_session, lock_open_sessions, place_orders,
+    valid_product_id
+)
+
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def locked(path, blocking=True):
+    """Hold an exclusive lock on the file, which raises `BlockingIOError` if not blocking."""
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def parse_entry(line) -> tuple:
+    """Parse a log entry into its `(session_code, product_id, timestamp)`, or raise `ValueError`."""
+    entry = json.loads(line)
+    session_code, product_id = entry["session_code"], entry["product_id"]
+    timestamp = parse_datetime(entry["timestamp"])
+    if not isinstance(session_code, str) or not valid_product_id(product_id) or timestamp is None:
+        raise ValueError(line)
+    return session_code, product_id, timestamp
+
+
+class OrderLog:
+
+    def __init__(self):
+        self._thread = BackgroundThread(self._run, "order-log-flusher")
+        # (inode, offset) of the flushed part of the log, while this process flushes it
+        self._position = None
+
+        self.appended = 0
+        self.flushed = 0
+        self.batches = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    @property
+    def path(self):
+        return settings.ORDER_INGESTION_LOG
+
+    def append(self, session_code, product_id) -> dict:
+        """
+        Durably append an order for an open session to the log and return its entry.
+
+        Returns None, if the session is closed, and raises `Session.DoesNotExist`,
+        if there is no such session.
+        """
+        with locked(self.path + ".lock"):
+            # the session can not be closed, before the order is appended
+            state = Session.objects.filter(pk=session_code).values_list("state", flat=True).first()
+            if state is None:
+                raise Session.DoesNotExist()
+            if state == SessionState.CLOSED.value:
+                return None
+
+            entry = {
+                "session_code": session_code,
+                "product_id": product_id,
+                "timestamp": timezone.now().isoformat(),
+            }
+            line = "{}\n".format(json.dumps(entry)).encode()
+            log = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(log, line)
+                os.fsync(log)
+            finally:
+                os.close(log)
+
+        self.appended += 1
+        self.ensure_flusher()
+        return entry
+
+    def flush(self, replace=True) -> int:
+        """
+        Insert the next batch of orders from the log into the database.
+
+        Must only be called while holding the flusher lock. Without replace,
+        a fully flushed log is kept, e.g. while the append lock is held.
+        Returns the number of flushed log entries.
+        """
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return 0
+
+        offset = self._load_offset(inode)
+        with open(self.path, "rb") as log:
+            log.seek(offset)
+            lines = []
+            for line in log:
+                # skip a line, which is still being written
+                if not line.endswith(b"\n") or len(lines) >= settings.ORDER_INGESTION_BATCH_SIZE:
+                    break
+                lines.append(line)
+
+        if not lines:
+            if replace:
+                self._replace_flushed_log(inode, offset)
+            return 0
+
+        entries = []
+        for line in lines:
+            try:
+                entries.append(parse_entry(line))
+            except (ValueError, KeyError, TypeError):
+                # a corrupt entry must not block the entries after it
+                logger.error("Skipping corrupt order log entry %r.", line)
+                self.skipped += 1
+
+        offset += sum(len(line) for line in lines)
+        with transaction.atomic():
+            # orders of sessions, which were deleted in the meantime, are dropped
+            sessions = lock_open_sessions({session_code for session_code, _, _ in entries})
+            orders = [
+                Order(session=sessions[session_code], product_id=product_id, timestamp=timestamp)
+                for session_code, product_id, timestamp in entries if session_code in sessions
+            ]
+            self.dropped += len(entries) - len(orders)
+            if orders:
+                place_orders(orders)
+            self._store_offset(inode, offset)
+
+        self.flushed += len(lines)
+        self.batches += 1
+        return len(lines)
+
+    def flush_all(self, replace=True) -> int:
+        """
+        Flush the whole log and return the number of flushed log entries.
+
+        If another flusher is running, wait until it has flushed the log.
+        """
+        while True:
+            try:
+                with locked(self.path + ".flusher", blocking=False):
+                    self._position = None
+                    flushed = 0
+                    while True:
+                        batch = self.flush(replace)
+                        if not batch:
+                            self._position = None
+                            return flushed
+                        flushed += batch
+            except BlockingIOError:
+                if not self.backlog():
+                    return 0
+                time.sleep(settings.ORDER_INGESTION_FLUSH_INTERVAL)
+
+    def close_session(self, session_code) -> dict:
+        """
+        Close a session like `models.close_session`, once its acknowledged orders are inserted.
+
+        No order is appended, while the log is flushed and the session is closed.
+        """
+        with locked(self.path + ".lock"):
+            self.flush_all(replace=False)
+            return close_session(session_code)
+
+    def backlog(self) -> int:
+        """Get the number of bytes in the log, which are not flushed yet."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return 0
+        checkpoint = IngestionCheckpoint.objects.filter(log=self.path).first()
+        if checkpoint is None or checkpoint.inode != stat.st_ino:
+            return stat.st_size
+        return stat.st_size - checkpoint.offset
+
+    def ensure_flusher(self):
+        """Start the background flusher of this process, if it is not running."""
+        self._thread.ensure_started()
+
+    def stats(self) -> dict:
+        return {
+            "mode": settings.ORDER_INGESTION,
+            "appended": self.appended,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+        }
+
+    def _run(self):
+        while True:
+            try:
+                with locked(self.path + ".flusher", blocking=False):
+                    self._position = None
+                    while True:
+                        if not self.flush():
+                            time.sleep(settings.ORDER_INGESTION_FLUSH_INTERVAL)
+            except BlockingIOError:
+                # another process flushes the log
+                time.sleep(settings.ORDER_INGESTION_FLUSH_INTERVAL)
+            except Exception:
+                logger.exception("Flushing the order log failed.")
+                self._position = None
+                connection.close()
+                time.sleep(settings.ORDER_INGESTION_FLUSH_INTERVAL)
+
+    def _load_offset(self, inode) -> int:
+        if self._position is None:
+            checkpoint = IngestionCheckpoint.objects.filter(log=self.path).first()
+            self._position = (checkpoint.inode, checkpoint.offset) if checkpoint else (inode, 0)
+        position_inode, offset = self._position
+        # the log is only replaced once it is fully flushed, so a new log starts at 0
+        return offset if position_inode == inode else 0
+
+    def _store_offset(self, inode, offset):
+        IngestionCheckpoint.objects.update_or_create(
+            log=self.path, defaults={"inode": inode, "offset": offset}
+        )
+        self._position = (inode, offset)
+
+    def _replace_flushed_log(self, inode, offset):
+        if offset < settings.ORDER_INGESTION_LOG_MAX_SIZE:
+            return
+        with locked(self.path + ".lock"):
+            # orders may have been appended in the meantime
+            if os.stat(self.path).st_size != offset:
+                return
+            with open(self.path + ".new", "wb"):
+                pass
+            os.replace(self.path + ".new", self.path)
+        self._store_offset(os.stat(self.path).st_ino, 0)
+
+
+order_log = OrderLog()
+
+metrics.register("ingestion", order_log.stats)
+
+
+def start_flusher(**kwargs):
+    # after a restart, orders which are still in the log are flushed right away
+    if settings.ORDER_INGESTION == "buffered":
+        order_log.ensure_flusher()
@@ -0,0 +1,217 @@
+"""
+Instrumentation of the hot paths.
+
+Latency histograms and gauges are kept per process and exposed in the
+Prometheus text format by `GET /orders/metrics/prometheus/`, together with
+the component metrics of `orders.metrics`. With `METRICS_ENABLED=0`, nothing
+is recorded and the middleware is not installed.
+"""
+import functools
+import re
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from . import metrics
+
+
+# upper bounds in seconds of the latency buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# upper bounds of the query count buckets
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+HISTOGRAMS = {
+    "orders_request_duration_seconds": ("Duration of the requests by view.", LATENCY_BUCKETS),
+    "orders_request_queries": ("Database queries of the requests by view.", QUERY_BUCKETS),
+    "orders_step_duration_seconds": ("Duration of the steps of the hot paths.", LATENCY_BUCKETS),
+    "orders_upstream_duration_seconds": ("Duration of the upstream requests, including retries.", LATENCY_BUCKETS),
+    "orders_broadcast_duration_seconds": ("Duration of the dispatch of a broadcast.", LATENCY_BUCKETS),
+    "orders_channel_layer_send_seconds": ("Duration of the channel layer group sends by group type.", LATENCY_BUCKETS),
+    "orders_websocket_send_seconds": ("Duration of the websocket frame sends by group type.", LATENCY_BUCKETS),
+}
+
+GAUGES = {
+    "orders_websocket_connections": "Open websocket connections by group type.",
+}
+
+
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # the last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # {(name, labels): Histogram}
+        self.histograms = {}
+        # {(name, labels): value}
+        self.gauges = {}
+
+    def observe(self, name, value, labels):
+        key = (name, labels)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+    def add(self, name, value, labels):
+        key = (name, labels)
+        with self._lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def render(self) -> str:
+        """Render the histograms, gauges and component metrics in the Prometheus text format."""
+        with self._lock:
+            histograms = {
+                key: (list(histogram.counts), histogram.sum)
+                for key, histogram in self.histograms.items()
+            }
+            gauges = dict(self.gauges)
+
+        lines = []
+        for name, (help_text, buckets) in HISTOGRAMS.items():
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} histogram".format(name)]
+            for (key_name, labels), (counts, total) in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(
+                        name, format_labels(labels + (("le", str(bound)),)), cumulative
+                    ))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), total))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+
+        for name, help_text in GAUGES.items():
+            lines += ["# HELP {} {}".format(name, help_text), "# TYPE {} gauge".format(name)]
+            for (key_name, labels), value in sorted(gauges.items()):
+                if key_name == name:
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+
+        for component, values in metrics.collect().items():
+            for path, value in flatten(values):
+                name = sanitize("orders_{}_{}".format(component, "_".join(path)))
+                lines += ["# TYPE {} gauge".format(name), "{} {}".format(name, value)]
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(label, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for label, value in labels
+    ))
+
+
+def sanitize(name) -> str:
+    return re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def flatten(values, path=()):
+    """Yield the `(path, value)` pairs of the numeric values of nested component metrics."""
+    for key, value in values.items():
+        if isinstance(value, dict):
+            yield from flatten(value, path + (str(key),))
+        elif isinstance(value, bool):
+            yield path + (str(key),), int(value)
+        elif isinstance(value, (int, float)):
+            yield path + (str(key),), value
+
+
+registry = Registry()
+
+
+def enabled() -> bool:
+    return settings.METRICS_ENABLED
+
+
+def observe(name, value, **labels):
+    """Record a value in the histogram with the labels."""
+    if enabled():
+        registry.observe(name, value, tuple(sorted(labels.items())))
+
+
+def add(name, value, **labels):
+    """Add a value to the gauge with the labels."""
+    if enabled():
+        registry.add(name, value, tuple(sorted(labels.items())))
+
+
+@contextmanager
+def timer(name, **labels):
+    """Record the duration of the block in the histogram with the labels."""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - started_at, **labels)
+
+
+def timed(name, **labels):
+    """Decorate a function to record its duration in the histogram with the labels."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled():
+                return func(*args, **kwargs)
+            started_at = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - started_at, **labels)
+        return wrapper
+    return decorator
+
+
+class QueryCounter:
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class InstrumentationMiddleware:
+    """Record the duration and the database queries of every request by view."""
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed()
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = QueryCounter()
+        started_at = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        duration = time.perf_counter() - started_at
+
+        match = request.resolver_match
+        view = match.url_name if match is not None else "unresolved"
+        observe(
+            "orders_request_duration_seconds", duration,
+            view=view, method=request.method, status="{}xx".format(response.status_code // 100)
+        )
+        observe("orders_request_queries", queries.count, view=view)
+        return response
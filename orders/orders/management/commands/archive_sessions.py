@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from orders.archive import archiver
+
+
+class Command(BaseCommand):
+    help = "Move closed sessions, which are older than ARCHIVE_AFTER_DAYS, with their orders to the archive."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, help="archive closed sessions older than this")
+
+    def handle(self, *args, **options):
+        archived = archiver.archive(days=options["days"])
+        self.stdout.write("Archived {} sessions.".format(archived))
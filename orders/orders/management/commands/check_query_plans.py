@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from orders.query_plans import explain_hot_queries, find_scans, find_sorts
+
+
+class Command(BaseCommand):
+    help = "Explain the hot queries and fail, if one of them scans a full table or sorts without an index."
+
+    def handle(self, *args, **options):
+        plans = explain_hot_queries()
+        for name, plan in plans.items():
+            self.stdout.write("{}:\n{}\n".format(name, plan))
+
+        scans = find_scans(plans)
+        if scans:
+            raise CommandError("Full table scans in: {}".format(", ".join(scans)))
+        sorts = find_sorts(plans)
+        if sorts:
+            raise CommandError("Sorts without an index in: {}".format(", ".join(sorts)))
+        self.stdout.write("No full table scans or sorts without an index in {} queries.".format(len(plans)))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from orders.ingestion import order_log
+
+
+class Command(BaseCommand):
+    help = "Insert all orders from the order ingestion log into the database."
+
+    def handle(self, *args, **options):
+        flushed = order_log.flush_all()
+        self.stdout.write("Flushed {} orders.".format(flushed))
@@ -0,0 +1,14 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from orders.codes import pool
+
+
+class Command(BaseCommand):
+    help = "Fill the code pool with codes from the codes service."
+
+    def handle(self, *args, **options):
+        added = pool.refill()
+        self.stdout.write("Added {} codes, the pool contains {} of {} codes.".format(
+            added, pool.size(), settings.CODE_POOL_SIZE
+        ))
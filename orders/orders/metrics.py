@@ -0,0 +1,13 @@
+"""Registry for the runtime metrics of the service components."""
+
+_collectors = {}
+
+
+def register(name, collector):
+    """Register a callable, which returns the current metrics of a component."""
+    _collectors[name] = collector
+
+
+def collect() -> dict:
+    """Collect the current metrics of all registered components."""
+    return {name: collector() for name, collector in _collectors.items()}
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.9 on 2026-10-18 17:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0002_auto_20200127_1911'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='session',
+            name='sequence',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
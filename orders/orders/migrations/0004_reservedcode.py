@@ -0,0 +1,21 @@
+# Generated by Django 2.2.9 on 2026-10-18 17:13
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0003_session_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReservedCode',
+            fields=[
+                ('code', models.CharField(max_length=6, primary_key=True, serialize=False)),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.9 on 2026-10-18 17:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0004_reservedcode'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionCheckpoint',
+            fields=[
+                ('log', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('inode', models.BigIntegerField()),
+                ('offset', models.BigIntegerField()),
+            ],
+        ),
+    ]
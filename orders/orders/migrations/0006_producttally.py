@@ -0,0 +1,39 @@
+# Generated by Django 2.2.9 on 2026-10-18 17:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def tally_existing_orders(apps, schema_editor):
+    Order = apps.get_model('orders', 'Order')
+    ProductTally = apps.get_model('orders', 'ProductTally')
+    rows = Order.objects \
+        .values('session_id', 'product_id') \
+        .annotate(count=models.Count('id'), first_ordered=models.Min('timestamp'), last_ordered=models.Max('timestamp')) \
+        .order_by()
+    ProductTally.objects.bulk_create((ProductTally(**row) for row in rows.iterator()), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0005_ingestioncheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductTally',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product_id', models.IntegerField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('first_ordered', models.DateTimeField()),
+                ('last_ordered', models.DateTimeField()),
+                ('session', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='orders.Session')),
+            ],
+            options={
+                'unique_together': {('session', 'product_id')},
+            },
+        ),
+        migrations.RunPython(tally_existing_orders, migrations.RunPython.noop),
+    ]
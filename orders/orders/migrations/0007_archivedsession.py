@@ -0,0 +1,37 @@
+# Generated by Django 2.2.9 on 2026-10-18 17:28
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0006_producttally'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=6)),
+                ('location_id', models.IntegerField()),
+                ('timestamp', models.DateTimeField()),
+                ('archived', models.DateTimeField(default=django.utils.timezone.now)),
+                ('payload', models.TextField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='archivedsession',
+            index=models.Index(fields=['code'], name='orders_arch_code_f5f4fa_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedsession',
+            index=models.Index(fields=['location_id', 'timestamp'], name='orders_arch_locatio_f3e8a4_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedsession',
+            index=models.Index(fields=['timestamp', 'code'], name='orders_arch_timesta_555bb5_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 2.2.9 on 2026-10-18 17:29
+
+from django.db import migrations, models
+from django.db.models.functions import Upper
+
+
+def normalize_states(apps, schema_editor):
+    Session = apps.get_model('orders', 'Session')
+    Session.objects.exclude(state__in=['OPEN', 'CLOSED']).update(state=Upper('state'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0007_archivedsession'),
+    ]
+
+    operations = [
+        migrations.RunPython(normalize_states, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='order',
+            name='orders_orde_session_aeca3b_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='session',
+            name='orders_sess_locatio_277a05_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='session',
+            name='orders_sess_state_b717c3_idx',
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['session', 'timestamp'], name='orders_orde_session_7eaae5_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['location_id', 'state', 'timestamp'], name='orders_sess_locatio_481c8b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['state', 'timestamp'], name='orders_sess_state_385809_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['timestamp', 'code'], name='orders_sess_timesta_a8887c_idx'),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 2.2.9 on 2026-10-18 18:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0008_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='archivedsession',
+            name='orders_arch_code_f5f4fa_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='archivedsession',
+            name='orders_arch_locatio_f3e8a4_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='session',
+            name='orders_sess_locatio_481c8b_idx',
+        ),
+        migrations.AddIndex(
+            model_name='archivedsession',
+            index=models.Index(fields=['code', 'timestamp'], name='orders_arch_code_aad276_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedsession',
+            index=models.Index(fields=['location_id', 'timestamp', 'code'], name='orders_arch_locatio_00f119_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='session',
+            index=models.Index(fields=['location_id', 'state', 'timestamp', 'code'], name='orders_sess_locatio_ea74aa_idx'),
+        ),
+    ]
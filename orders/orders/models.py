@@ -1,13 +1,20 @@
+from collections import defaultdict
 from enum import Enum
+from functools import partial
 
-from asgiref.sync import async_to_sync
-from channels.layers import get_channel_layer
-from django.db import models
+from django.conf import settings
+from django.db import IntegrityError, connection, models, transaction
+from django.db.models.functions import Greatest, Least
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from django.forms import model_to_dict
 from django.utils import timezone
 
+from . import instrumentation
+from .broadcast import dispatcher
+
+
+MISSING = object()
+
 
 class SessionState(Enum):
     OPEN = "OPEN"
@@ -18,6 +25,12 @@ class SessionState(Enum):
         return tuple((k.name, k.value) for k in cls)
 
 
+class SessionEvent(Enum):
+    ORDER_ADDED = "order_added"
+    ORDERS_ADDED = "orders_added"
+    STATE_CHANGED = "state_changed"
+
+
 class Session(models.Model):
     # mandatory fields
     code = models.CharField(max_length=6, primary_key=True)
@@ -29,42 +42,154 @@ class Session(models.Model):
 
     # autogenerated fields
     timestamp = models.DateTimeField(default=timezone.now)
+    sequence = models.PositiveIntegerField(default=0)
 
     class Meta:
         unique_together = ["name", "location_id"]
         indexes = [
-            models.Index(fields=["location_id"]),
-            models.Index(fields=["state"]),
+            # find_session and the location channel, by location and state, in the order of the cursor
+            models.Index(fields=["location_id", "state", "timestamp", "code"]),
+            # the archiver, by state and age
+            models.Index(fields=["state", "timestamp"]),
+            # pages of find_session without filters
+            models.Index(fields=["timestamp", "code"]),
         ]
 
+    # fields, whose changes are broadcast by saves
+    BROADCAST_FIELDS = ("name", "location_id", "state", "timestamp")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        session = super().from_db(db, field_names, values)
+        session.remember_saved_fields()
+        return session
+
+    def remember_saved_fields(self):
+        self._saved_fields = {name: self.__dict__[name] for name in self.BROADCAST_FIELDS if name in self.__dict__}
+
+    def changed_fields(self) -> set:
+        """Get the broadcast fields, which differ from the loaded or saved session, or all of them if unknown."""
+        saved = getattr(self, "_saved_fields", {})
+        # deferred fields, which were never loaded, are unchanged
+        return {
+            name for name in self.BROADCAST_FIELDS
+            if name in self.__dict__ and saved.get(name, MISSING) != self.__dict__[name]
+        }
+
     @property
     def accepts_orders(self):
         return not self.state == SessionState.CLOSED
 
     @property
     def dict_representation(self):
-        session_dict = model_to_dict(self)
-        session_dict["orders"] = [
-            order.dict_representation for order in self.order_set.all()
-        ]
-        session_dict["timestamp"] = session_dict["timestamp"].isoformat()
-        return session_dict
+        from .serializers import serialize_session
+        return serialize_session(self)
 
     @property
     def group_name(self):
         return "session_{}".format(self.code)
 
+    @property
+    def location_group_name(self):
+        return location_group_name(self.location_id)
+
+    def save(self, *args, **kwargs):
+        # the sequence number is only advanced with updates, a full save must not write back a stale one
+        if not self._state.adding and kwargs.get("update_fields") is None:
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != "sequence"
+            ]
+        super().save(*args, **kwargs)
+        self.remember_saved_fields()
+
+    def advance_sequence(self):
+        """Atomically increment and return the sequence number of the session."""
+        with transaction.atomic():
+            Session.objects.filter(pk=self.pk).update(sequence=models.F("sequence") + 1)
+            self.sequence = Session.objects.values_list("sequence", flat=True).get(pk=self.pk)
+        return self.sequence
+
+    def broadcast(self, message):
+        """
+        Send a message to all consumers of the session and its location.
+
+        The message is queued for the broadcast dispatcher,
+        once the current transaction commits.
+        """
+        group_names = (self.group_name, self.location_group_name)
+        transaction.on_commit(partial(dispatcher.enqueue, group_names, message))
+
     def broadcast_session_update(self):
-        """Broadcast session updates to the channel layer."""
-        channel_layer = get_channel_layer()
-        async_to_sync(channel_layer.group_send)(
-            self.group_name, {"type": "session_update", "session": self.dict_representation}
-        )
+        """Broadcast the full session to the channel layer."""
+        # the snapshot is built by the dispatcher, after the commit
+        self.broadcast(partial(session_snapshot, self.code))
+
+    def broadcast_event(self, event, **data):
+        """Advance the sequence number of the session and broadcast a session event."""
+        self.advance_sequence()
+        self.publish_event(event, **data)
+
+    def broadcast_snapshot(self):
+        """Advance the sequence number of the session and broadcast the full session, also with deltas."""
+        from .snapshots import snapshot_cache
+        self.advance_sequence()
+        transaction.on_commit(partial(snapshot_cache.invalidate, self.code))
+        self.broadcast_session_update()
+
+    def publish_event(self, event, snapshot=None, **data):
+        """
+        Broadcast a session event, whose sequence number was already advanced.
+
+        Every event carries the sequence number and the state of the session,
+        so that clients can detect missed events and request a resync.
+        A serialized session, which was read after the event, is broadcast
+        as the snapshot instead of building another one.
+        """
+        from .snapshots import snapshot_cache
+        transaction.on_commit(partial(snapshot_cache.invalidate, self.code))
+        if not settings.SESSION_BROADCAST_DELTAS:
+            if snapshot is None:
+                self.broadcast_session_update()
+            else:
+                self.broadcast({"session": snapshot})
+            return
+        message = {
+            "event": event.value,
+            "sequence": self.sequence,
+            "session_code": self.code,
+            "state": self.state,
+        }
+        message.update(data)
+        self.broadcast(message)
+
+
+def location_group_name(location_id):
+    return "location_{}".format(location_id)
+
+
+@instrumentation.timed("orders_step_duration_seconds", step="session_snapshot")
+def session_snapshot(session_code):
+    """Build the snapshot message of a session, or None if it was deleted in the meantime."""
+    from .serializers import serialize_sessions
+    sessions = serialize_sessions(Session.objects.filter(pk=session_code))
+    return {"session": sessions[0]} if sessions else None
 
 
 @receiver(post_save, sender=Session, dispatch_uid="session_post_save")
-def session_post_save(sender, instance, **kwargs):
-    instance.broadcast_session_update()
+def session_post_save(sender, instance, created, **kwargs):
+    # only the location has subscribers for newly created sessions
+    if created:
+        instance.broadcast_session_update()
+        return
+    changed = instance.changed_fields()
+    if kwargs.get("update_fields"):
+        changed &= set(kwargs["update_fields"])
+    if changed == {"state"}:
+        instance.broadcast_event(SessionEvent.STATE_CHANGED, state=instance.state)
+        return
+    # other changes, e.g. renames, have no event, the full session replaces the one of the clients
+    instance.broadcast_snapshot()
 
 
 class Order(models.Model):
@@ -78,16 +203,257 @@ class Order(models.Model):
 
     class Meta:
         indexes = [
-            models.Index(fields=["session"])
+            models.Index(fields=["session", "timestamp"])
         ]
 
     @property
     def dict_representation(self):
-        order_dict = model_to_dict(self)
-        order_dict["timestamp"] = order_dict["timestamp"].isoformat()
-        return order_dict
+        from .serializers import ORDER_FIELDS, OrderRow, serialize_order
+        return serialize_order(OrderRow._make(getattr(self, field) for field in ORDER_FIELDS))
 
 
 @receiver(post_save, sender=Order, dispatch_uid="order_post_save")
-def order_post_save(sender, instance, **kwargs):
-    instance.session.broadcast_session_update()
+def order_post_save(sender, instance, created, **kwargs):
+    if not created:
+        return
+    products = tally_orders([instance])
+    instance.session.broadcast_event(
+        SessionEvent.ORDER_ADDED,
+        order=instance.dict_representation,
+        products=products[instance.session_id]
+    )
+
+
+def close_session(session_code) -> dict:
+    """
+    Close a session with one conditional update and return the serialized session.
+
+    Only the update, which actually closes the session, broadcasts the state
+    change. Raises `Session.DoesNotExist`, if there is no such session.
+    """
+    from .serializers import serialize_session
+
+    with transaction.atomic():
+        closed = Session.objects \
+            .filter(code__exact=session_code, state=SessionState.OPEN.value) \
+            .update(state=SessionState.CLOSED.value, sequence=models.F("sequence") + 1)
+        session = Session.objects.get(code__exact=session_code)
+        serialized = serialize_session(session)
+        if closed:
+            session.publish_event(SessionEvent.STATE_CHANGED, snapshot=serialized, state=session.state)
+    return serialized
+
+
+def insert_order(session_code, product_id, timestamp):
+    """
+    Insert an order with one INSERT ... SELECT, if the session is open.
+
+    Returns the id of the order, or None if the session is closed or missing.
+    """
+    quote_name = connection.ops.quote_name
+    order_table, session_table = Order._meta.db_table, Session._meta.db_table
+    sql = "INSERT INTO {} ({}, {}, {}) SELECT %s, {}, %s FROM {} WHERE {} = %s AND {} = %s".format(
+        quote_name(order_table), quote_name("product_id"), quote_name("session_id"), quote_name("timestamp"),
+        quote_name("code"), quote_name(session_table), quote_name("code"), quote_name("state"),
+    )
+    params = [
+        Order._meta.get_field("product_id").get_db_prep_value(product_id, connection),
+        Order._meta.get_field("timestamp").get_db_prep_value(timestamp, connection),
+        session_code,
+        SessionState.OPEN.value,
+    ]
+    if connection.vendor == "postgresql":
+        # a concurrent close must commit first, then the session is no longer selected
+        sql += " FOR SHARE"
+    if connection.features.can_return_id_from_insert:
+        sql += " " + connection.ops.return_insert_id()[0] % quote_name("id")
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        if connection.features.can_return_id_from_insert:
+            row = cursor.fetchone()
+            return row[0] if row else None
+        if not cursor.rowcount:
+            return None
+        return connection.ops.last_insert_id(cursor, order_table, "id")
+
+
+def add_order(session_code, product_id) -> dict:
+    """
+    Add an order to an open session and return the serialized session.
+
+    The order is only inserted, if the session is open in the same statement,
+    so that no order slips in after the session was closed. Returns None,
+    if the session is closed, and raises `Session.DoesNotExist`, if there is
+    no such session.
+    """
+    from .serializers import serialize_session
+
+    timestamp = timezone.now()
+    with transaction.atomic():
+        order_id = insert_order(session_code, product_id, timestamp)
+        if order_id is None:
+            if not Session.objects.filter(code__exact=session_code).exists():
+                raise Session.DoesNotExist()
+            return None
+
+        # advance the sequence number and load the session together
+        Session.objects.filter(code__exact=session_code).update(sequence=models.F("sequence") + 1)
+        session = Session.objects.get(code__exact=session_code)
+        order = Order(id=order_id, product_id=product_id, session=session, timestamp=timestamp)
+        products = tally_orders([order])
+        # events do not carry the session, which is then read after the commit,
+        # so that the write lock is released early
+        serialized = None if settings.SESSION_BROADCAST_DELTAS else serialize_session(session)
+        session.publish_event(
+            SessionEvent.ORDER_ADDED,
+            snapshot=serialized,
+            order=order.dict_representation,
+            products=products[session_code]
+        )
+    return serialized or serialize_session(session)
+
+
+class ProductTally(models.Model):
+    # number of orders of a product in a session, maintained on every order insert
+    session = models.ForeignKey(Session, on_delete=models.CASCADE)
+    product_id = models.IntegerField()
+    count = models.PositiveIntegerField(default=0)
+    first_ordered = models.DateTimeField()
+    last_ordered = models.DateTimeField()
+
+    class Meta:
+        unique_together = ["session", "product_id"]
+
+
+def tally_orders(orders) -> dict:
+    """
+    Add inserted orders to the product tallies of their sessions.
+
+    Must be called in the transaction, which inserted the orders.
+    Returns the serialized tallies of the ordered products by session code.
+    """
+    from .serializers import products_by_session
+
+    timestamps = defaultdict(list)
+    for order in orders:
+        timestamps[(order.session_id, order.product_id)].append(order.timestamp)
+
+    for (session_code, product_id), ordered in timestamps.items():
+        tallies = ProductTally.objects.filter(session_id=session_code, product_id=product_id)
+        changes = dict(
+            count=models.F("count") + len(ordered),
+            first_ordered=Least("first_ordered", models.Value(min(ordered), output_field=models.DateTimeField())),
+            last_ordered=Greatest("last_ordered", models.Value(max(ordered), output_field=models.DateTimeField())),
+        )
+        if tallies.update(**changes):
+            continue
+        try:
+            with transaction.atomic():
+                ProductTally.objects.create(
+                    session_id=session_code,
+                    product_id=product_id,
+                    count=len(ordered),
+                    first_ordered=min(ordered),
+                    last_ordered=max(ordered),
+                )
+        except IntegrityError:
+            # a concurrent insert created the tally first
+            tallies.update(**changes)
+
+    products = products_by_session(ProductTally.objects.filter(
+        session_id__in={session_code for session_code, _ in timestamps},
+        product_id__in={product_id for _, product_id in timestamps},
+    ))
+    return {
+        session_code: [
+            product for product in session_products
+            if (session_code, product["product_id"]) in timestamps
+        ]
+        for session_code, session_products in products.items()
+    }
+
+
+def valid_product_id(value) -> bool:
+    """Check, that a product id of a request or of the order log is a positive integer."""
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def lock_open_sessions(session_codes) -> dict:
+    """
+    Lock the open sessions of the codes until the end of the transaction and return them by code.
+
+    The update does not change anything, but it takes the row locks, or the
+    write lock on SQLite, so that no session is closed before the orders are inserted.
+    """
+    sessions = Session.objects.filter(code__in=session_codes, state=SessionState.OPEN.value)
+    sessions.update(sequence=models.F("sequence"))
+    return sessions.in_bulk()
+
+
+def place_orders(orders) -> dict:
+    """
+    Insert unsaved orders with one bulk insert.
+
+    Instead of one event per order, one orders_added event is broadcast
+    per session. Returns the created orders by session code.
+    """
+    sessions = {order.session.code: order.session for order in orders}
+
+    with transaction.atomic():
+        Order.objects.bulk_create(orders)
+        if orders and orders[0].pk is None:
+            # only some databases return the ids of bulk inserted rows
+            orders = Order.objects \
+                .filter(
+                    session_id__in=sessions,
+                    timestamp__in={order.timestamp for order in orders}
+                ) \
+                .order_by("id")
+
+        orders_by_session = defaultdict(list)
+        for order in orders:
+            orders_by_session[order.session_id].append(order)
+
+        products = tally_orders(orders)
+        for code, session_orders in orders_by_session.items():
+            sessions[code].broadcast_event(
+                SessionEvent.ORDERS_ADDED,
+                orders=[order.dict_representation for order in session_orders],
+                products=products[code]
+            )
+
+    return orders_by_session
+
+
+class ReservedCode(models.Model):
+    # codes fetched from the codes service ahead of time
+    code = models.CharField(max_length=6, primary_key=True)
+
+    # autogenerated fields
+    timestamp = models.DateTimeField(default=timezone.now)
+
+
+class IngestionCheckpoint(models.Model):
+    # position in the order ingestion log, up to which orders were inserted
+    log = models.CharField(max_length=255, primary_key=True)
+    inode = models.BigIntegerField()
+    offset = models.BigIntegerField()
+
+
+class ArchivedSession(models.Model):
+    # closed sessions, which were moved out of the session and order tables
+    code = models.CharField(max_length=6)
+    location_id = models.IntegerField()
+    timestamp = models.DateTimeField()
+    archived = models.DateTimeField(default=timezone.now)
+    # the encoded session together with its orders and product tallies
+    payload = models.TextField()
+
+    class Meta:
+        indexes = [
+            # the last archived session of a code
+            models.Index(fields=["code", "timestamp"]),
+            models.Index(fields=["location_id", "timestamp", "code"]),
+            models.Index(fields=["timestamp", "code"]),
+        ]
@@ -0,0 +1,67 @@
+"""
+Keyset pagination of sessions on `(timestamp, code)`.
+
+Cursors are opaque to clients: they encode the position
+of the last session of a page, from which the next page starts.
+"""
+import base64
+import binascii
+import json
+from itertools import islice
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+from . import encoding
+from .serializers import SESSION_FIELDS, SessionRow, attach_orders
+
+
+ORDERING = ("timestamp", "code")
+
+
+def encode_cursor(session: dict) -> str:
+    """Encode the position of a serialized session into a cursor."""
+    position = json.dumps([session["timestamp"].isoformat(), session["code"]])
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple:
+    """Decode a cursor into a `(timestamp, code)` position."""
+    try:
+        timestamp, code = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        timestamp = parse_datetime(timestamp)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise ValueError()
+    if timestamp is None or not isinstance(code, str):
+        raise ValueError()
+    return timestamp, code
+
+
+def after_cursor(sessions, cursor: str):
+    """Order the sessions and only keep those after the cursor."""
+    sessions = sessions.order_by(*ORDERING)
+    if not cursor:
+        return sessions
+    timestamp, code = decode_cursor(cursor)
+    # the redundant lower bound lets the database seek in the (timestamp, code) index
+    return sessions.filter(timestamp__gte=timestamp).filter(
+        Q(timestamp__gt=timestamp) | Q(timestamp=timestamp, code__gt=code)
+    )
+
+
+def stream_sessions(sessions, chunk_size=100):
+    """
+    Serialize the sessions into a JSON array, chunk by chunk.
+
+    Only one chunk of sessions and their orders is held in memory at a time.
+    """
+    rows = map(SessionRow._make, sessions.values_list(*SESSION_FIELDS).iterator(chunk_size=chunk_size))
+    separator = b"["
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        for session in attach_orders(chunk):
+            yield separator + encoding.dumps(session)
+            separator = b","
+    yield b"[]" if separator == b"[" else b"]"
@@ -0,0 +1,89 @@
+"""
+Query plan checks of the hot queries.
+
+Every hot query is explained on the configured database, and its plan
+must not contain a full table scan. On PostgreSQL, sequential scans are
+disabled for the check, since the planner prefers them on small tables.
+On SQLite, the plans must not sort in a temporary B-tree either, so that
+the ORDER BY of every hot query is served by its index.
+"""
+import re
+from datetime import timedelta
+
+from django.db import connection
+from django.utils import timezone
+
+from .models import ArchivedSession, Order, ProductTally, Session, SessionState
+from .pagination import after_cursor, encode_cursor
+from .serializers import ORDER_FIELDS, PRODUCT_FIELDS, SESSION_FIELDS
+
+
+# SQLite: "SCAN orders_session" without an index, PostgreSQL: "Seq Scan on orders_session"
+SCAN_PATTERNS = {
+    "sqlite": re.compile(r"\bSCAN (TABLE )?\w+\s*$", re.MULTILINE),
+    "postgresql": re.compile(r"\bSeq Scan\b"),
+}
+
+# SQLite: "USE TEMP B-TREE FOR ORDER BY", if the index does not provide the order
+SORT_PATTERNS = {
+    "sqlite": re.compile(r"\bUSE TEMP B-TREE\b"),
+}
+
+
+def hot_queries() -> dict:
+    """Get the querysets of the hot queries by name."""
+    cursor = encode_cursor({"timestamp": timezone.now(), "code": "000000"})
+    sessions = Session.objects.values_list(*SESSION_FIELDS)
+    return {
+        "get_session": Session.objects.filter(code__exact="000000").values_list("sequence"),
+        "find_session": after_cursor(sessions, None)[:100],
+        "find_session by cursor": after_cursor(sessions, cursor)[:100],
+        "find_session by location and state": after_cursor(
+            sessions.filter(location_id__exact=1, state__exact=SessionState.OPEN.value), cursor
+        )[:100],
+        "location sessions": sessions.filter(
+            location_id=1, state__in=[SessionState.OPEN.value]
+        ).order_by("timestamp"),
+        "orders of sessions": Order.objects.filter(
+            session_id__in=["000000", "000001"]
+        ).order_by("session_id", "timestamp", "id").values_list(*ORDER_FIELDS),
+        "product tallies of sessions": ProductTally.objects.filter(
+            session_id__in=["000000", "000001"]
+        ).order_by("session_id", "product_id").values_list("session_id", *PRODUCT_FIELDS),
+        "archivable sessions": Session.objects.filter(
+            state=SessionState.CLOSED.value, timestamp__lt=timezone.now() - timedelta(days=30)
+        ).order_by("timestamp").values_list("code")[:500],
+        "archived session": ArchivedSession.objects.filter(
+            code__exact="000000"
+        ).order_by("-timestamp").values_list("payload")[:1],
+        "find_archived_session by location": after_cursor(
+            ArchivedSession.objects.filter(location_id__exact=1), cursor
+        ).values_list("payload")[:100],
+    }
+
+
+def explain_hot_queries() -> dict:
+    """Explain the hot queries and return their plans by name."""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute("SET enable_seqscan = off")
+    try:
+        return {name: queryset.explain() for name, queryset in hot_queries().items()}
+    finally:
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("RESET enable_seqscan")
+
+
+def find_scans(plans) -> list:
+    """Get the names of the queries, whose plans contain a full table scan."""
+    pattern = SCAN_PATTERNS[connection.vendor]
+    return [name for name, plan in plans.items() if pattern.search(plan)]
+
+
+def find_sorts(plans) -> list:
+    """Get the names of the queries, whose plans sort in a temporary B-tree on SQLite."""
+    pattern = SORT_PATTERNS.get(connection.vendor)
+    if pattern is None:
+        return []
+    return [name for name, plan in plans.items() if pattern.search(plan)]
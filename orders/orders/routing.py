@@ -1,14 +1,11 @@
 from channels.auth import AuthMiddlewareStack
 from channels.routing import ProtocolTypeRouter, URLRouter
-from django.urls import re_path
 
-from . import consumers
+from .routing_api import websocket_urlpatterns
 
 
 application = ProtocolTypeRouter({
     'websocket': AuthMiddlewareStack(
-        URLRouter([
-            re_path(r'ws/session/(?P<session_code>\w+)/$', consumers.SessionConsumer),
-        ])
+        URLRouter(websocket_urlpatterns)
     )
 })
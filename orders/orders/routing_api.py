@@ -0,0 +1,16 @@
+"""Websocket routing of the API workers, without the session and auth middleware."""
+from channels.routing import ProtocolTypeRouter, URLRouter
+from django.urls import re_path
+
+from . import consumers
+
+
+# the consumers do not use the session or the user of the scope
+websocket_urlpatterns = [
+    re_path(r'ws/session/(?P<session_code>\w+)/$', consumers.SessionConsumer),
+    re_path(r'ws/location/(?P<location_id>\d+)/$', consumers.LocationConsumer),
+]
+
+application = ProtocolTypeRouter({
+    'websocket': URLRouter(websocket_urlpatterns),
+})
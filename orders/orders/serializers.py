@@ -0,0 +1,99 @@
+"""
+Serialization of sessions and their orders.
+
+Sessions, orders and product tallies are read with `values_list()` into
+slotted read models, so that any number of sessions is serialized with three
+queries and without instantiating any model. Timestamps are left to the JSON
+encoder.
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import NamedTuple
+
+from .models import Order, ProductTally, Session
+
+
+class SessionRow(NamedTuple):
+    """Read model of a session."""
+    code: str
+    name: str
+    location_id: int
+    state: str
+    timestamp: datetime
+    sequence: int
+
+
+class OrderRow(NamedTuple):
+    """Read model of an order."""
+    id: int
+    product_id: int
+    session: str
+    timestamp: datetime
+
+
+class ProductRow(NamedTuple):
+    """Read model of the product tally of a session."""
+    product_id: int
+    count: int
+    first_ordered: datetime
+    last_ordered: datetime
+
+
+SESSION_FIELDS = SessionRow._fields
+PRODUCT_FIELDS = ProductRow._fields
+# the columns of the order read model
+ORDER_FIELDS = ("id", "product_id", "session_id", "timestamp")
+
+
+def read_sessions(sessions) -> list:
+    """Read a queryset of sessions into read models."""
+    return [SessionRow._make(row) for row in sessions.values_list(*SESSION_FIELDS)]
+
+
+def serialize_order(order: OrderRow) -> dict:
+    """Serialize an order from its read model."""
+    return order._asdict()
+
+
+def products_by_session(tallies) -> dict:
+    """Serialize a queryset of product tallies by their session code."""
+    products = defaultdict(list)
+    # in the order of the (session, product_id) index
+    for row in tallies.order_by("session_id", "product_id").values_list("session_id", *PRODUCT_FIELDS):
+        products[row[0]].append(ProductRow._make(row[1:])._asdict())
+    return products
+
+
+def attach_orders(sessions: list) -> list:
+    """Serialize the read models of sessions together with their orders and product tallies."""
+    session_codes = [session.code for session in sessions]
+    products = products_by_session(ProductTally.objects.filter(session_id__in=session_codes))
+    orders = defaultdict(list)
+    # in the order of the (session, timestamp) index, orders with the same timestamp by their id
+    rows = Order.objects \
+        .filter(session_id__in=session_codes) \
+        .order_by("session_id", "timestamp", "id") \
+        .values_list(*ORDER_FIELDS)
+    for row in rows:
+        order = OrderRow._make(row)
+        orders[order.session].append(order._asdict())
+
+    serialized = []
+    for session in sessions:
+        session_dict = session._asdict()
+        session_dict["orders"] = orders[session.code]
+        session_dict["products"] = products[session.code]
+        serialized.append(session_dict)
+    return serialized
+
+
+def serialize_sessions(sessions) -> list:
+    """Serialize a queryset of sessions together with their orders."""
+    return attach_orders(read_sessions(sessions))
+
+
+def serialize_session(session: Session) -> dict:
+    """Serialize a loaded session together with its orders."""
+    return attach_orders([
+        SessionRow._make(getattr(session, field) for field in SESSION_FIELDS)
+    ])[0]
@@ -38,12 +38,13 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
 
-    'orders',
+    'orders.apps.OrdersConfig',
 
     'channels',
 ]
 
 MIDDLEWARE = [
+    'orders.instrumentation.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -74,29 +75,86 @@ TEMPLATES = [
 WSGI_APPLICATION = 'orders.wsgi.application'
 ASGI_APPLICATION = 'orders.routing.application'
 
+# Redis shards of the channel layer as "host:port,host:port", session groups are placed by their code
+CHANNEL_LAYER_SHARDS = [
+    (host, int(port))
+    for host, port in (
+        shard.strip().rsplit(":", 1)
+        for shard in os.environ.get('CHANNEL_LAYER_SHARDS', default='').split(",") if shard.strip()
+    )
+]
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
+        'BACKEND': (
+            'orders.sharding.ShardedRedisChannelLayer' if CHANNEL_LAYER_SHARDS
+            else 'channels_redis.core.RedisChannelLayer'
+        ),
         'CONFIG': {
-            'hosts': [
+            'hosts': CHANNEL_LAYER_SHARDS or [
                 (os.environ.get('REDIS_HOST', default='redis'), int(os.environ.get('REDIS_PORT', default=6379)))
-            ]
+            ],
+            'capacity': int(os.environ.get('CHANNEL_LAYER_CAPACITY', default=100)),
         }
     }
 }
 
+# Record latency histograms and query counts, which are exposed on /orders/metrics/prometheus/
+METRICS_ENABLED = bool(int(os.environ.get("METRICS_ENABLED", default=1)))
+
+# Size of the thread pool, which runs the database calls of the websocket consumers
+CONSUMER_DATABASE_THREADS = int(os.environ.get("CONSUMER_DATABASE_THREADS", default=4))
+
+# Number of frames, which are buffered per websocket client, before they are replaced by a resync
+CONSUMER_SEND_BUFFER = int(os.environ.get("CONSUMER_SEND_BUFFER", default=32))
+
+# Websocket clients are disconnected after more buffer overflows than this within the window
+CONSUMER_MAX_OVERFLOWS = int(os.environ.get("CONSUMER_MAX_OVERFLOWS", default=3))
+
+# Window in seconds, in which the buffer overflows of a websocket client are counted
+CONSUMER_OVERFLOW_WINDOW = float(os.environ.get("CONSUMER_OVERFLOW_WINDOW", default=60))
+
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': os.environ.get('SQL_ENGINE', default='django.db.backends.sqlite3'),
+DATABASE_PROFILES = {
+    # single host: WAL lets readers proceed next to the order writers, the pragmas
+    # are applied to every new connection (see orders.databases), which is kept open
+    'sqlite': {
+        'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.environ.get('SQL_DATABASE', default=os.path.join(BASE_DIR, 'orders.db.sqlite3')),
+        'CONN_MAX_AGE': int(os.environ.get('SQL_CONN_MAX_AGE', default=60)),
+        'PRAGMAS': {
+            'journal_mode': os.environ.get('SQLITE_JOURNAL_MODE', default='WAL'),
+            'synchronous': os.environ.get('SQLITE_SYNCHRONOUS', default='NORMAL'),
+            # milliseconds, which a writer waits for the lock of another one
+            'busy_timeout': int(os.environ.get('SQLITE_BUSY_TIMEOUT', default=5000)),
+        },
+    },
+    # production: persistent connections, which are checked before they are reused
+    'postgresql': {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': os.environ.get('SQL_DATABASE', default='orders'),
         'USER': os.environ.get('SQL_USER', default='user'),
         'PASSWORD': os.environ.get('SQL_PASSWORD', default='password'),
         'HOST': os.environ.get('SQL_HOST', default='localhost'),
         'PORT': os.environ.get('SQL_PORT', default='5432'),
-    }
+        'CONN_MAX_AGE': int(os.environ.get('SQL_CONN_MAX_AGE', default=60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'connect_timeout': int(os.environ.get('SQL_CONNECT_TIMEOUT', default=5)),
+        },
+    },
+}
+
+# Database profile: "sqlite" or "postgresql", which is derived from SQL_ENGINE if not set
+DATABASE_PROFILE = os.environ.get(
+    'DATABASE_PROFILE',
+    default='postgresql' if 'postgresql' in os.environ.get('SQL_ENGINE', default='') else 'sqlite'
+)
+
+DATABASES = {
+    'default': DATABASE_PROFILES[DATABASE_PROFILE]
 }
 
 
@@ -140,10 +198,85 @@ STATIC_URL = '/static/'
 
 MAX_RESULTS = 100
 
+# Maximum number of orders, which can be placed with one bulk request
+MAX_BULK_ORDERS = 100
+
+# Order ingestion: "direct" inserts orders in the request, "buffered" appends them to
+# ORDER_INGESTION_LOG and inserts them in batches of ORDER_INGESTION_BATCH_SIZE in the background
+ORDER_INGESTION = os.environ.get("ORDER_INGESTION", default="direct")
+ORDER_INGESTION_LOG = os.environ.get(
+    "ORDER_INGESTION_LOG", default=os.path.join(BASE_DIR, "orders.ingestion.log")
+)
+ORDER_INGESTION_BATCH_SIZE = int(os.environ.get("ORDER_INGESTION_BATCH_SIZE", default=500))
+ORDER_INGESTION_FLUSH_INTERVAL = float(os.environ.get("ORDER_INGESTION_FLUSH_INTERVAL", default=0.1))
+# Size in bytes, from which a fully flushed log is replaced by an empty one
+ORDER_INGESTION_LOG_MAX_SIZE = int(os.environ.get("ORDER_INGESTION_LOG_MAX_SIZE", default=16 * 1024 * 1024))
+
+# Closed sessions older than this are moved to the archive, in batches of ARCHIVE_BATCH_SIZE
+ARCHIVE_AFTER_DAYS = int(os.environ.get("ARCHIVE_AFTER_DAYS", default=30))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("ARCHIVE_BATCH_SIZE", default=500))
+# Interval in seconds of the background archiver, which is disabled with 0
+ARCHIVE_INTERVAL = float(os.environ.get("ARCHIVE_INTERVAL", default=0))
+ARCHIVE_LOCK = os.environ.get("ARCHIVE_LOCK", default=os.path.join(BASE_DIR, "orders.archive.lock"))
+
+# Cache backend and time in seconds for the encoded session snapshots
+SNAPSHOT_CACHE_ALIAS = os.environ.get("SNAPSHOT_CACHE_ALIAS", default="default")
+SNAPSHOT_CACHE_TTL = int(os.environ.get("SNAPSHOT_CACHE_TTL", default=3600))
+
+# JSON encoder of responses and broadcasts: "auto" (orjson, if it is installed), "orjson" or "json"
+JSON_ENCODER = os.environ.get("JSON_ENCODER", default="auto")
+
+# Broadcast order_added / state_changed events instead of full session snapshots
+SESSION_BROADCAST_DELTAS = bool(int(os.environ.get("SESSION_BROADCAST_DELTAS", default=0)))
+
+# Time in seconds, during which broadcasts to the same session are coalesced into one message
+BROADCAST_COALESCE_WINDOW = float(os.environ.get("BROADCAST_COALESCE_WINDOW", default=0.05))
+
 VERIFICATION_SERVICE_URL = os.environ.get("VERIFICATION_SERVICE_URL", default="http://verification:8000")
 LOCATIONS_SERVICE_URL = os.environ.get("LOCATIONS_SERVICE_URL", default="http://locations:8000")
 CODES_SERVICE_URL = os.environ.get("CODES_SERVICE_URL", default="http://codes:8000")
 
+# Timeouts in seconds for the requests to the upstream services
+VERIFICATION_SERVICE_TIMEOUT = float(os.environ.get("VERIFICATION_SERVICE_TIMEOUT", default=2))
+LOCATIONS_SERVICE_TIMEOUT = float(os.environ.get("LOCATIONS_SERVICE_TIMEOUT", default=2))
+CODES_SERVICE_TIMEOUT = float(os.environ.get("CODES_SERVICE_TIMEOUT", default=2))
+
+# Upstream requests slower than these budgets in seconds count as failures for the circuit breakers
+VERIFICATION_SERVICE_LATENCY_BUDGET = float(os.environ.get("VERIFICATION_SERVICE_LATENCY_BUDGET", default=1))
+LOCATIONS_SERVICE_LATENCY_BUDGET = float(os.environ.get("LOCATIONS_SERVICE_LATENCY_BUDGET", default=1))
+CODES_SERVICE_LATENCY_BUDGET = float(os.environ.get("CODES_SERVICE_LATENCY_BUDGET", default=1))
+
+# The circuit breaker of a service opens after this many consecutive failures and half-opens after the timeout
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = int(os.environ.get("CIRCUIT_BREAKER_FAILURE_THRESHOLD", default=5))
+CIRCUIT_BREAKER_RESET_TIMEOUT = float(os.environ.get("CIRCUIT_BREAKER_RESET_TIMEOUT", default=30))
+
+# Retries of failed upstream requests, with a jittered backoff starting at UPSTREAM_BACKOFF seconds
+UPSTREAM_RETRIES = int(os.environ.get("UPSTREAM_RETRIES", default=2))
+UPSTREAM_BACKOFF = float(os.environ.get("UPSTREAM_BACKOFF", default=0.05))
+
+# Number of keep-alive connections per upstream service
+UPSTREAM_POOL_SIZE = int(os.environ.get("UPSTREAM_POOL_SIZE", default=10))
+
+# Pool of codes fetched ahead of time, refilled up to CODE_POOL_SIZE below CODE_POOL_LOW_WATER,
+# 0 disables the pool
+CODE_POOL_SIZE = int(os.environ.get("CODE_POOL_SIZE", default=50))
+CODE_POOL_LOW_WATER = int(os.environ.get("CODE_POOL_LOW_WATER", default=10))
+# If the pool is empty, either "fetch" a code from the codes service or "fail"
+CODE_POOL_FALLBACK = os.environ.get("CODE_POOL_FALLBACK", default="fetch")
+
+# Cache for verifications and location owners: "local" (per process)
+# or "django" (the UPSTREAM_CACHE_ALIAS backend)
+UPSTREAM_CACHE = os.environ.get("UPSTREAM_CACHE", default="local")
+UPSTREAM_CACHE_ALIAS = os.environ.get("UPSTREAM_CACHE_ALIAS", default="default")
+UPSTREAM_CACHE_MAX_SIZE = int(os.environ.get("UPSTREAM_CACHE_MAX_SIZE", default=10000))
+
+# Time in seconds to cache successful and failed lookups, 0 disables caching
+UPSTREAM_CACHE_TTL = int(os.environ.get("UPSTREAM_CACHE_TTL", default=300))
+UPSTREAM_CACHE_NEGATIVE_TTL = int(os.environ.get("UPSTREAM_CACHE_NEGATIVE_TTL", default=30))
+
+# Token in the X-Invalidation-Token header of cache invalidations, the endpoint is disabled without it
+CACHE_INVALIDATION_TOKEN = os.environ.get("CACHE_INVALIDATION_TOKEN", default="")
+
 # Setup support for proxy headers
 USE_X_FORWARDED_HOST = True
-SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
\ No newline at end of file
+SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
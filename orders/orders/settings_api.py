@@ -0,0 +1,40 @@
+"""
+Settings of the API workers.
+
+The API workers only serve the orders API and the websockets. They do not
+load the admin, auth, sessions, messages and static files, and the sockets
+are not wrapped in the session and auth middleware, which would look up a
+user on every connect. Select them with
+
+    DJANGO_SETTINGS_MODULE=orders.settings_api daphne orders.asgi:application
+"""
+from .settings import *  # noqa: F401,F403
+
+
+INSTALLED_APPS = [
+    'orders.apps.OrdersConfig',
+]
+
+MIDDLEWARE = [
+    'orders.instrumentation.InstrumentationMiddleware',
+    'django.middleware.security.SecurityMiddleware',
+    'django.middleware.common.CommonMiddleware',
+]
+
+ROOT_URLCONF = 'orders.urls_api'
+
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [],
+        'APP_DIRS': True,
+        'OPTIONS': {
+            'context_processors': [
+                'django.template.context_processors.debug',
+                'django.template.context_processors.request',
+            ],
+        },
+    },
+]
+
+ASGI_APPLICATION = 'orders.routing_api.application'
@@ -0,0 +1,73 @@
+"""
+Sharding of the channel layer over several Redis hosts.
+
+Groups and channels are placed on the hosts with a consistent hash ring,
+so that adding or removing a host only moves the groups of about one host.
+Session groups are placed by the session code, so that the shard of a
+session is known without the group name.
+"""
+import hashlib
+from bisect import bisect
+
+from channels_redis.core import RedisChannelLayer
+
+
+SESSION_GROUP_PREFIX = "session_"
+
+
+def ring_hash(key) -> int:
+    return int.from_bytes(hashlib.md5(key.encode("utf8")).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hash ring, which places every node on the ring several times."""
+
+    def __init__(self, nodes, virtual_nodes=128):
+        self.nodes = list(nodes)
+        points = sorted(
+            (ring_hash("{}#{}".format(node, replica)), node)
+            for node in self.nodes for replica in range(virtual_nodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, key):
+        """Get the node of a key, which is the next node clockwise on the ring."""
+        index = bisect(self._hashes, ring_hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+def shard_key(name) -> str:
+    """Get the key, by which a group or channel is placed: the code of session groups, otherwise the name."""
+    if name.startswith(SESSION_GROUP_PREFIX):
+        return name[len(SESSION_GROUP_PREFIX):]
+    return name
+
+
+def shard_name(host) -> str:
+    """Get the name of a host on the ring, which does not change with its position in the host list."""
+    address = host.get("address", host)
+    if isinstance(address, (list, tuple)):
+        return "{}:{}".format(*address)
+    return str(address)
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """
+    Redis channel layer, which places groups and channels with a consistent hash ring.
+
+    The membership of a group is stored on the shard of the group, and
+    every message of a group send is delivered to the shard of its channel,
+    like with the modulo placement of `RedisChannelLayer`.
+    """
+
+    def __init__(self, hosts=None, virtual_nodes=128, **kwargs):
+        super().__init__(hosts=hosts, **kwargs)
+        names = [shard_name(host) for host in self.hosts]
+        self.ring = HashRing(names, virtual_nodes)
+        self.shard_indexes = {name: index for index, name in enumerate(names)}
+
+    def consistent_hash(self, value):
+        if isinstance(value, bytes):
+            value = value.decode("utf8")
+        return self.shard_indexes[self.ring.node(shard_key(value))]
@@ -0,0 +1,67 @@
+"""
+Cache of encoded session snapshots.
+
+A snapshot is the JSON encoded full session, which is stored together with
+the sequence number of the session it was built from. Since every session
+event advances the sequence number, a cached snapshot is valid as long as
+its sequence number matches the one in the database.
+"""
+from django.conf import settings
+from django.core.cache import caches
+
+from . import encoding, metrics
+from .models import Session
+from .serializers import serialize_sessions
+
+
+class SnapshotCache:
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def cache(self):
+        return caches[settings.SNAPSHOT_CACHE_ALIAS]
+
+    def make_key(self, session_code) -> str:
+        return "orders:snapshot:{}".format(session_code)
+
+    def get(self, session_code, sequence) -> tuple:
+        """
+        Get the `(sequence, snapshot)` of the session, build it if the cached one is outdated.
+
+        Raises `Session.DoesNotExist`, if there is no such session.
+        """
+        cached = self.cache.get(self.make_key(session_code))
+        if cached is not None and cached[0] == sequence:
+            self.hits += 1
+            return cached
+
+        self.misses += 1
+        sessions = serialize_sessions(Session.objects.filter(code__exact=session_code))
+        if not sessions:
+            raise Session.DoesNotExist()
+
+        # the session may have changed since the sequence was read
+        return self.put(sessions[0])
+
+    def put(self, session) -> tuple:
+        """Encode and cache a serialized session, which was read after its last event, and return its `(sequence, snapshot)`."""
+        cached = (session["sequence"], encoding.dumps(session))
+        self.cache.set(self.make_key(session["code"]), cached, settings.SNAPSHOT_CACHE_TTL)
+        return cached
+
+    def invalidate(self, session_code):
+        self.cache.delete(self.make_key(session_code))
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+snapshot_cache = SnapshotCache()
+
+metrics.register("snapshots", snapshot_cache.stats)
@@ -0,0 +1,554 @@
+import asyncio
+import json
+import os
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+import requests
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import caches
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import cache, models, upstream
+from .breaker import BreakerState, CircuitBreaker
+from .ingestion import OrderLog
+from .models import IngestionCheckpoint, Order, Session, SessionState
+from .pagination import decode_cursor, encode_cursor
+from .query_plans import explain_hot_queries, find_scans, find_sorts
+from .sharding import HashRing, ShardedRedisChannelLayer, shard_key
+
+
+def create_sessions(location_id, count, orders=3) -> list:
+    sessions = Session.objects.bulk_create(
+        Session(code="{}{:05d}".format(location_id, number), name="Session {}".format(number), location_id=location_id)
+        for number in range(count)
+    )
+    Order.objects.bulk_create(
+        Order(session=session, product_id=product_id)
+        for session in sessions for product_id in range(1, orders + 1)
+    )
+    return sessions
+
+
+class SessionQueryTests(TestCase):
+    """The queries of the session views must not grow with the number of sessions or orders."""
+
+    def setUp(self):
+        caches[settings.SNAPSHOT_CACHE_ALIAS].clear()
+
+    def find_sessions(self, location_id) -> int:
+        # the page of sessions, then their tallies and orders
+        with self.assertNumQueries(3):
+            response = self.client.get("/orders/sessions/find/", {"location_id": location_id})
+        self.assertEqual(response.status_code, 200)
+        return len(response.json())
+
+    def test_find_session(self):
+        create_sessions(1, 1)
+        create_sessions(2, settings.MAX_RESULTS)
+
+        self.assertEqual(self.find_sessions(1), 1)
+        self.assertEqual(self.find_sessions(2), settings.MAX_RESULTS)
+
+    def test_get_session(self):
+        few, = create_sessions(3, 1, orders=1)
+        many, = create_sessions(4, 1, orders=50)
+
+        for session, orders in ((few, 1), (many, 50)):
+            # the sequence, then the session, its tallies and orders for the snapshot
+            with self.assertNumQueries(4):
+                response = self.client.get("/orders/sessions/get/{}/".format(session.code))
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.json()["orders"]), orders)
+
+            # the cached snapshot only needs the sequence
+            with self.assertNumQueries(1):
+                response = self.client.get("/orders/sessions/get/{}/".format(session.code))
+            self.assertEqual(response.status_code, 200)
+
+
+class QueryPlanTests(TestCase):
+
+    def test_hot_queries_use_indexes(self):
+        plans = explain_hot_queries()
+        self.assertEqual(find_scans(plans), [], plans)
+        # e.g. "USE TEMP B-TREE FOR ORDER BY" on SQLite
+        self.assertEqual(find_sorts(plans), [], plans)
+
+
+class HashRingTests(SimpleTestCase):
+
+    codes = ["{:06d}".format(code) for code in range(0, 10 ** 6, 97)]
+    shards = ["shard{}:6379".format(index) for index in range(4)]
+
+    def placements(self, ring) -> dict:
+        return {code: ring.node(code) for code in self.codes}
+
+    def test_groups_are_spread_evenly(self):
+        placements = self.placements(HashRing(self.shards))
+
+        counts = [list(placements.values()).count(shard) for shard in self.shards]
+        self.assertLess(max(counts), 1.25 * len(self.codes) / len(self.shards))
+
+    def test_adding_a_shard_only_moves_groups_to_it(self):
+        before = self.placements(HashRing(self.shards))
+        after = self.placements(HashRing(self.shards + ["shard4:6379"]))
+
+        moved = [code for code in self.codes if before[code] != after[code]]
+        self.assertEqual({after[code] for code in moved}, {"shard4:6379"})
+        self.assertLess(len(moved), 2 * len(self.codes) / (len(self.shards) + 1))
+
+    def test_removing_a_shard_only_moves_its_groups(self):
+        before = self.placements(HashRing(self.shards))
+        after = self.placements(HashRing(self.shards[:-1]))
+
+        moved = [code for code in self.codes if before[code] != after[code]]
+        self.assertEqual({before[code] for code in moved}, {self.shards[-1]})
+
+    def test_placement_does_not_depend_on_the_host_order(self):
+        self.assertEqual(self.placements(HashRing(self.shards)), self.placements(HashRing(self.shards[::-1])))
+
+    def test_session_groups_are_placed_by_their_code(self):
+        hosts = [("shard{}".format(index), 6379) for index in range(4)]
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+
+        self.assertEqual(shard_key("session_587944"), "587944")
+        for code in self.codes[:100]:
+            index = layer.consistent_hash("session_{}".format(code))
+            self.assertEqual(layer.ring.nodes[index], layer.ring.node(code))
+            self.assertEqual(layer.consistent_hash("session_{}".format(code).encode()), index)
+
+
+@override_settings(CIRCUIT_BREAKER_FAILURE_THRESHOLD=2, CIRCUIT_BREAKER_RESET_TIMEOUT=30)
+class CircuitBreakerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker("test", "CODES_SERVICE_LATENCY_BUDGET")
+        patcher = mock.patch("orders.breaker.time.monotonic", return_value=1000.0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_breaker(self):
+        for _ in range(2):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.open_breaker()
+
+        self.assertEqual(self.breaker.state, BreakerState.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats()["rejected"], 1)
+
+    def test_successes_reset_the_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_success(0)
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+
+    def test_slow_calls_count_as_failures(self):
+        for _ in range(2):
+            self.breaker.record_success(settings.CODES_SERVICE_LATENCY_BUDGET + 1)
+
+        self.assertEqual(self.breaker.state, BreakerState.OPEN)
+
+    def test_half_open_breaker_lets_one_trial_through(self):
+        self.open_breaker()
+        self.monotonic.return_value += 30
+
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, BreakerState.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+        self.breaker.record_success(0)
+        self.assertEqual(self.breaker.state, BreakerState.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_reopens_the_breaker(self):
+        self.open_breaker()
+        self.monotonic.return_value += 30
+
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+
+        self.assertEqual(self.breaker.state, BreakerState.OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_trial_is_released_after_an_unexpected_exception(self):
+        self.open_breaker()
+        self.monotonic.return_value += 30
+        self.assertTrue(self.breaker.allow())
+
+        self.breaker.release_trial()
+
+        self.assertTrue(self.breaker.allow())
+
+
+@override_settings(UPSTREAM_RETRIES=1, UPSTREAM_BACKOFF=0)
+class UpstreamRequestTests(SimpleTestCase):
+
+    def setUp(self):
+        self.breaker = upstream.breakers["codes"]
+        self.reset_breaker()
+        self.addCleanup(self.reset_breaker)
+        patcher = mock.patch.object(upstream, "get_session")
+        self.session = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+
+    def reset_breaker(self):
+        self.breaker.state, self.breaker.failures, self.breaker.trial_running = BreakerState.CLOSED, 0, False
+
+    def test_request_exceptions_are_retried_and_raise_service_unavailable(self):
+        self.session.request.side_effect = requests.exceptions.InvalidURL()
+
+        with self.assertRaises(upstream.ServiceUnavailable):
+            upstream.get("codes", "/codes/new/")
+        self.assertEqual(self.session.request.call_count, 2)
+
+    def test_half_open_trial_is_released_after_any_exception(self):
+        self.breaker.state, self.breaker.opened_at = BreakerState.OPEN, -10 ** 6
+        self.session.request.side_effect = KeyError()
+
+        with self.assertRaises(KeyError):
+            upstream.get("codes", "/codes/new/")
+        self.assertFalse(self.breaker.trial_running)
+
+
+class LocalCacheTests(SimpleTestCase):
+
+    def test_entries_expire_after_their_ttl(self):
+        local = cache.LocalCache(max_size=10)
+        with mock.patch("orders.cache.time.monotonic", return_value=1000.0) as monotonic:
+            local.set("key", "value", ttl=5)
+            self.assertEqual(local.get("key"), "value")
+            monotonic.return_value += 5
+            self.assertIsNone(local.get("key"))
+
+    def test_least_recently_used_entries_are_evicted(self):
+        local = cache.LocalCache(max_size=2)
+        local.set("a", 1, ttl=60)
+        local.set("b", 2, ttl=60)
+        local.get("a")
+        local.set("c", 3, ttl=60)
+
+        self.assertEqual(local.get("a"), 1)
+        self.assertIsNone(local.get("b"))
+        self.assertEqual(local.get("c"), 3)
+
+
+@override_settings(UPSTREAM_CACHE="local", UPSTREAM_CACHE_TTL=300, UPSTREAM_CACHE_NEGATIVE_TTL=30)
+class LookupCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.lookups = cache.LookupCache("test")
+        self.func = mock.Mock()
+
+    def test_results_are_cached(self):
+        self.func.return_value = 1
+
+        self.assertEqual(self.lookups.lookup(("a",), self.func), 1)
+        self.assertEqual(self.lookups.lookup(("a",), self.func), 1)
+        self.assertEqual(self.func.call_count, 1)
+        self.assertEqual(self.lookups.stats(), {"hits": 1, "negative_hits": 0, "misses": 1})
+
+    def test_failed_lookups_are_cached_for_the_negative_ttl(self):
+        self.func.return_value = None
+
+        with mock.patch("orders.cache.time.monotonic", return_value=1000.0) as monotonic:
+            self.lookups.lookup(("a",), self.func)
+            self.lookups.lookup(("a",), self.func)
+            self.assertEqual(self.func.call_count, 1)
+            monotonic.return_value += 30
+            self.lookups.lookup(("a",), self.func)
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_service_errors_are_not_cached(self):
+        self.func.side_effect = upstream.ServiceUnavailable("verification")
+
+        for _ in range(2):
+            with self.assertRaises(upstream.ServiceUnavailable):
+                self.lookups.lookup(("a",), self.func)
+        self.assertEqual(self.func.call_count, 2)
+
+    def test_invalidated_entries_are_looked_up_again(self):
+        self.func.return_value = 1
+        self.lookups.lookup(("a",), self.func)
+
+        self.lookups.invalidate("a")
+        self.lookups.lookup(("a",), self.func)
+
+        self.assertEqual(self.func.call_count, 2)
+
+
+class BulkOrderTests(TestCase):
+
+    def setUp(self):
+        Session.objects.create(code="000001", name="Open", location_id=1)
+        Session.objects.create(code="000002", name="Closed", location_id=1, state=SessionState.CLOSED.value)
+
+    def add(self, *orders):
+        return self.client.post(
+            "/orders/products/add/bulk/", json.dumps({"orders": list(orders)}), content_type="application/json"
+        )
+
+    def test_orders_are_inserted_with_their_quantities(self):
+        response = self.add(
+            {"session_code": "000001", "product_id": 1, "quantity": 3},
+            {"session_code": "000001", "product_id": 2},
+        )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            sorted(Order.objects.values_list("product_id", flat=True)), [1, 1, 1, 2]
+        )
+
+    def test_malformed_orders_are_rejected(self):
+        for order in (
+            {"session_code": ["000001"], "product_id": 1},
+            {"session_code": "000001", "product_id": "1"},
+            {"session_code": "000001", "product_id": True},
+            {"session_code": "000001", "product_id": 0},
+            {"session_code": "000001", "product_id": 1, "quantity": True},
+            {"session_code": "000001", "product_id": 1, "quantity": 0},
+            ["000001", 1],
+        ):
+            with self.subTest(order=order):
+                self.assertEqual(self.add(order).status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_quantities_above_the_limit_are_rejected(self):
+        response = self.add({"session_code": "000001", "product_id": 1, "quantity": 10 ** 9})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+    def test_no_order_is_inserted_if_a_session_is_closed_or_missing(self):
+        closed = self.add({"session_code": "000001", "product_id": 1}, {"session_code": "000002", "product_id": 1})
+        missing = self.add({"session_code": "000001", "product_id": 1}, {"session_code": "000003", "product_id": 1})
+
+        self.assertEqual(closed.json(), {"reason": "session_closed"})
+        self.assertEqual(missing.status_code, 404)
+        self.assertFalse(Order.objects.exists())
+
+
+class CloseSessionTests(TestCase):
+
+    def setUp(self):
+        Session.objects.create(code="000001", name="Open", location_id=1)
+
+    def test_no_order_is_added_after_the_close(self):
+        models.close_session("000001")
+
+        response = self.client.post(
+            "/orders/products/add/", json.dumps({"session_code": "000001", "product_id": 1}),
+            content_type="application/json"
+        )
+
+        self.assertEqual(response.json(), {"reason": "session_closed"})
+        self.assertIsNone(models.insert_order("000001", 1, timezone.now()))
+        self.assertFalse(Order.objects.exists())
+
+    def test_orders_are_only_inserted_into_existing_open_sessions(self):
+        self.assertIsNotNone(models.insert_order("000001", 1, timezone.now()))
+        self.assertIsNone(models.insert_order("000002", 1, timezone.now()))
+        with self.assertRaises(Session.DoesNotExist):
+            models.add_order("000002", 1)
+
+    def test_only_the_first_close_advances_the_sequence(self):
+        first = models.close_session("000001")
+        second = models.close_session("000001")
+
+        self.assertEqual(first["state"], SessionState.CLOSED.value)
+        self.assertEqual(first["sequence"], 1)
+        self.assertEqual(second["sequence"], 1)
+
+
+@override_settings(SESSION_BROADCAST_DELTAS=True)
+class SessionBroadcastTests(TestCase):
+
+    def setUp(self):
+        Session.objects.create(code="000001", name="Open", location_id=1)
+        patcher = mock.patch.object(Session, "broadcast")
+        self.broadcast = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_state_changes_are_broadcast_as_events(self):
+        session = Session.objects.get(pk="000001")
+        session.state = SessionState.CLOSED.value
+        session.save()
+
+        message = self.broadcast.call_args[0][0]
+        self.assertEqual(message["event"], "state_changed")
+        self.assertEqual((message["state"], message["sequence"]), (SessionState.CLOSED.value, 1))
+
+    def test_other_changes_are_broadcast_as_the_full_session(self):
+        session = Session.objects.get(pk="000001")
+        session.name = "Renamed"
+        session.state = SessionState.CLOSED.value
+        session.save()
+
+        snapshot = self.broadcast.call_args[0][0]()
+        self.assertEqual(snapshot["session"]["name"], "Renamed")
+        self.assertEqual(snapshot["session"]["state"], SessionState.CLOSED.value)
+        self.assertEqual(snapshot["session"]["sequence"], 1)
+
+
+class CursorTests(TestCase):
+
+    def setUp(self):
+        sessions = create_sessions(1, 7, orders=1)
+        # sessions with equal timestamps are ordered by their code
+        timestamp = timezone.now()
+        for index, session in enumerate(sessions):
+            Session.objects.filter(pk=session.pk).update(timestamp=timestamp + timedelta(seconds=index // 3))
+        self.codes = [session.code for session in sessions]
+
+    def test_cursor_round_trip(self):
+        session = {"timestamp": timezone.now(), "code": "100001"}
+
+        self.assertEqual(decode_cursor(encode_cursor(session)), (session["timestamp"], "100001"))
+
+    @override_settings(MAX_RESULTS=2)
+    def test_pages_contain_every_session_once_in_order(self):
+        codes, cursor = [], None
+        while True:
+            params = {"location_id": 1}
+            if cursor:
+                params["cursor"] = cursor
+            response = self.client.get("/orders/sessions/find/", params)
+            self.assertEqual(response.status_code, 200)
+            codes += [session["code"] for session in response.json()]
+            cursor = response.get("X-Next-Cursor")
+            if cursor is None:
+                break
+
+        self.assertEqual(codes, self.codes)
+
+    def test_malformed_cursors_are_rejected(self):
+        for cursor in ("not a cursor", encode_cursor({"timestamp": timezone.now(), "code": "1"})[:-4], "W10="):
+            with self.subTest(cursor=cursor):
+                response = self.client.get("/orders/sessions/find/", {"cursor": cursor})
+                self.assertEqual(response.json(), {"reason": "malformed_cursor"})
+
+
+class OrderLogTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, "orders.ingestion.log")
+        for manager in (
+            override_settings(ORDER_INGESTION_LOG=self.path, ORDER_INGESTION_BATCH_SIZE=2),
+            # the log is flushed by the tests, not by a background flusher
+            mock.patch.object(OrderLog, "ensure_flusher"),
+        ):
+            manager.__enter__()
+            self.addCleanup(manager.__exit__, None, None, None)
+        Session.objects.create(code="000001", name="Open", location_id=1)
+        self.log = OrderLog()
+
+    def test_flushed_orders_are_checkpointed(self):
+        for product_id in (1, 2, 3):
+            self.log.append("000001", product_id)
+
+        self.assertEqual(self.log.flush_all(), 3)
+
+        checkpoint = IngestionCheckpoint.objects.get(log=self.path)
+        self.assertEqual(checkpoint.offset, os.path.getsize(self.path))
+        self.assertEqual(self.log.backlog(), 0)
+        self.assertEqual(sorted(Order.objects.values_list("product_id", flat=True)), [1, 2, 3])
+
+    def test_restarted_log_continues_from_the_checkpoint(self):
+        self.log.append("000001", 1)
+        self.log.flush_all()
+        self.log.append("000001", 2)
+
+        self.assertEqual(OrderLog().flush_all(), 1)
+        self.assertEqual(sorted(Order.objects.values_list("product_id", flat=True)), [1, 2])
+
+    def test_corrupt_entries_are_skipped(self):
+        self.log.append("000001", 1)
+        with open(self.path, "ab") as log:
+            log.write(b'{"session_code": "000001"}\nnot json\n')
+        self.log.append("000001", 2)
+
+        with self.assertLogs("orders.ingestion", "ERROR"):
+            self.assertEqual(self.log.flush_all(), 4)
+        self.assertEqual(self.log.skipped, 2)
+        self.assertEqual(sorted(Order.objects.values_list("product_id", flat=True)), [1, 2])
+
+    def test_acknowledged_orders_are_inserted_before_the_close(self):
+        self.log.append("000001", 1)
+
+        session = self.log.close_session("000001")
+
+        self.assertEqual(session["state"], SessionState.CLOSED.value)
+        self.assertEqual([order["product_id"] for order in session["orders"]], [1])
+        self.assertIsNone(self.log.append("000001", 2))
+        with self.assertRaises(Session.DoesNotExist):
+            self.log.append("000002", 1)
+
+
+@override_settings(CHANNEL_LAYERS={"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}})
+class SessionConsumerTests(TransactionTestCase):
+    # the consumers load the sessions on their own threads, which must see the committed sessions
+
+    def setUp(self):
+        from .routing import application
+
+        self.application = application
+        self.session = Session.objects.create(code="000001", name="Open", location_id=1)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def communicate(self, coroutine):
+        return self.loop.run_until_complete(asyncio.wait_for(coroutine, timeout=5))
+
+    def test_connected_clients_receive_the_session(self):
+        async def connect():
+            communicator = WebsocketCommunicator(self.application, "/ws/session/000001/")
+            connected, _ = await communicator.connect()
+            snapshot = await communicator.receive_json_from()
+            await communicator.disconnect()
+            return connected, snapshot
+
+        connected, snapshot = self.communicate(connect())
+
+        self.assertTrue(connected)
+        self.assertEqual((snapshot["code"], snapshot["orders"]), ("000001", []))
+
+    def test_resync_returns_the_current_session(self):
+        async def resync():
+            communicator = WebsocketCommunicator(self.application, "/ws/session/000001/")
+            await communicator.connect()
+            await communicator.receive_json_from()
+            await self.loop.run_in_executor(None, models.add_order, "000001", 7)
+            await communicator.send_json_to({"action": "resync"})
+            # updates may arrive before the resync
+            while True:
+                frame = await communicator.receive_json_from()
+                if "session" in frame:
+                    break
+            await communicator.disconnect()
+            return frame["session"]
+
+        session = self.communicate(resync())
+
+        self.assertEqual([order["product_id"] for order in session["orders"]], [7])
+        self.assertEqual(session["sequence"], Session.objects.get(pk="000001").sequence)
+
+    def test_unknown_sessions_are_rejected(self):
+        async def connect():
+            communicator = WebsocketCommunicator(self.application, "/ws/session/000002/")
+            connected = await communicator.connect()
+            await communicator.disconnect()
+            return connected
+
+        connected, code = self.communicate(connect())
+
+        self.assertFalse(connected)
+        self.assertEqual(code, 404)
@@ -0,0 +1,147 @@
+"""
+Shared client for the verification, locations and codes services.
+
+All requests go through one pooled keep-alive session per process,
+with per-service timeouts, retries with jittered exponential backoff
+and a circuit breaker per service.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+
+from . import metrics
+from .breaker import CircuitBreaker
+
+if TYPE_CHECKING:
+    import requests
+
+
+# service name -> names of the url, timeout and latency budget settings
+SERVICES = {
+    "verification": (
+        "VERIFICATION_SERVICE_URL", "VERIFICATION_SERVICE_TIMEOUT", "VERIFICATION_SERVICE_LATENCY_BUDGET"
+    ),
+    "locations": (
+        "LOCATIONS_SERVICE_URL", "LOCATIONS_SERVICE_TIMEOUT", "LOCATIONS_SERVICE_LATENCY_BUDGET"
+    ),
+    "codes": (
+        "CODES_SERVICE_URL", "CODES_SERVICE_TIMEOUT", "CODES_SERVICE_LATENCY_BUDGET"
+    ),
+}
+
+breakers = {
+    service: CircuitBreaker(service, latency_budget_setting)
+    for service, (_, _, latency_budget_setting) in SERVICES.items()
+}
+
+# responses with these status codes are retried like connection failures
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+# client errors, which do not answer the request either, e.g. rate limits
+TRANSIENT_STATUS_CODES = (408, 429)
+
+
+class ServiceUnavailable(Exception):
+    """Raised when an upstream service can not be reached."""
+
+
+_session = None
+_session_lock = threading.Lock()
+_executor = None
+
+
+def get_session() -> "requests.Session":
+    """Get the pooled session, which is shared by all threads."""
+    # requests is imported with the first upstream request, websocket workers never need it
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _session
+    with _session_lock:
+        if _session is None:
+            adapter = HTTPAdapter(
+                pool_connections=len(SERVICES),
+                pool_maxsize=settings.UPSTREAM_POOL_SIZE,
+            )
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def submit(func, *args, **kwargs):
+    """Run a call to an upstream service in the background and return its future."""
+    global _executor
+    with _session_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.UPSTREAM_POOL_SIZE,
+                thread_name_prefix="upstream",
+            )
+    return _executor.submit(func, *args, **kwargs)
+
+
+def backoff(attempt: int) -> float:
+    """Get the delay before a retry, with full jitter."""
+    return random.uniform(0, settings.UPSTREAM_BACKOFF * 2 ** attempt)
+
+
+def request(service: str, method: str, path: str, **kwargs) -> "requests.Response":
+    """
+    Send a request to an upstream service.
+
+    Failed requests, e.g. connection failures or timeouts, and gateway errors are retried
+    `UPSTREAM_RETRIES` times, before `ServiceUnavailable` is raised.
+    While the circuit breaker of the service is open, it is raised immediately.
+    """
+    import requests
+
+    url_setting, timeout_setting, _ = SERVICES[service]
+    url = "{}{}".format(getattr(settings, url_setting), path)
+    timeout = getattr(settings, timeout_setting)
+    breaker = breakers[service]
+
+    for attempt in range(settings.UPSTREAM_RETRIES + 1):
+        if not breaker.allow():
+            break
+        if attempt:
+            time.sleep(backoff(attempt - 1))
+        started_at = time.monotonic()
+        try:
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+            if response.status_code in RETRY_STATUS_CODES:
+                breaker.record_failure()
+                continue
+            breaker.record_success(time.monotonic() - started_at)
+            return response
+        except requests.RequestException:
+            breaker.record_failure()
+        finally:
+            # a half-open breaker must not wait forever for a trial, which raised something else
+            breaker.release_trial()
+
+    raise ServiceUnavailable(service)
+
+
+def check_response(service: str, response: "requests.Response"):
+    """Raise `ServiceUnavailable` for server errors and transient client errors, which are no answer."""
+    if response.status_code >= 500 or response.status_code in TRANSIENT_STATUS_CODES:
+        raise ServiceUnavailable(service)
+
+
+def get(service: str, path: str, **kwargs) -> "requests.Response":
+    return request(service, "GET", path, **kwargs)
+
+
+def post(service: str, path: str, **kwargs) -> "requests.Response":
+    return request(service, "POST", path, **kwargs)
+
+
+metrics.register("circuit_breakers", lambda: {
+    service: breaker.stats() for service, breaker in breakers.items()
+})
@@ -0,0 +1,20 @@
+"""URLs of the orders API, which are served by the API workers without the admin."""
+from django.urls import path
+
+from . import views
+
+
+urlpatterns = [
+    path('orders/sessions/create/', views.create_session, name="create_session"),
+    path('orders/sessions/get/<session_code>/', views.get_session, name="get_session"),
+    path('orders/sessions/close/<session_code>/', views.close_session, name="close_session"),
+    path('orders/sessions/find/', views.find_session, name="find_session"),
+    path('orders/archive/sessions/get/<session_code>/', views.get_archived_session, name="get_archived_session"),
+    path('orders/archive/sessions/find/', views.find_archived_session, name="find_archived_session"),
+    path('orders/products/add/', views.add_product_to_session, name="add_product_to_session"),
+    path('orders/products/add/bulk/', views.add_products_to_sessions, name="add_products_to_sessions"),
+    path('orders/sessions/monitor/<session_code>/', views.monitor_session, name="monitor_session"),
+    path('orders/metrics/', views.metrics_summary, name="metrics_summary"),
+    path('orders/metrics/prometheus/', views.metrics_prometheus, name="metrics_prometheus"),
+    path('orders/cache/invalidate/', views.invalidate_cache, name="invalidate_cache"),
+]
@@ -1,17 +1,35 @@
+import hmac
 import json
 from json import JSONDecodeError
 
-import requests
-from django.db import IntegrityError
-from django.http import JsonResponse
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.template.response import TemplateResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
 
-from . import settings
-from .models import Session, Order, SessionState
+from . import cache, codes, encoding, ingestion, instrumentation, metrics, models, upstream
+from .models import ArchivedSession, Session, Order, lock_open_sessions, place_orders, valid_product_id
+from .pagination import after_cursor, encode_cursor, stream_sessions
+from .serializers import attach_orders, read_sessions, serialize_session, serialize_sessions
+from .snapshots import snapshot_cache
 
 
-class SuccessResponse(JsonResponse):
+class EncodedJsonResponse(HttpResponse):
+    """Like JsonResponse, but encodes its data with the configured JSON encoder."""
+
+    def __init__(self, data, safe=True, **kwargs):
+        if safe and not isinstance(data, dict):
+            raise TypeError(
+                "In order to allow non-dict objects to be serialized set the safe parameter to False."
+            )
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content=encoding.dumps(data), **kwargs)
+
+
+class SuccessResponse(EncodedJsonResponse):
     status_code = 200
 
     def __init__(self, response=None, *args, **kwargs):
@@ -21,7 +39,19 @@ class SuccessResponse(JsonResponse):
             super().__init__(response, *args, **kwargs)
 
 
-class AbstractFailureResponse(JsonResponse):
+class EncodedResponse(HttpResponse):
+    status_code = 200
+
+    def __init__(self, content, *args, **kwargs):
+        kwargs.setdefault("content_type", "application/json")
+        super().__init__(content, *args, **kwargs)
+
+
+class OrderAccepted(SuccessResponse):
+    status_code = 202
+
+
+class AbstractFailureResponse(EncodedJsonResponse):
     reason = None
 
     def __init__(self, *args, **kwargs):
@@ -73,6 +103,12 @@ class SessionClosed(AbstractFailureResponse):
     reason = "session_closed"
     status_code = 400
 
+
+class MalformedCursor(AbstractFailureResponse):
+    reason = "malformed_cursor"
+    status_code = 400
+
+
 def monitor_session(request, session_code) -> TemplateResponse:
     """Render a session to monitor web sockets."""
     return render(request, "orders/monitor_session.html", {
@@ -80,6 +116,64 @@ def monitor_session(request, session_code) -> TemplateResponse:
     })
 
 
+def metrics_summary(request) -> JsonResponse:
+    """Get the runtime metrics of the service via GET."""
+
+    if request.method != "GET":
+        return IncorrectAccessMethod()
+
+    return SuccessResponse(metrics.collect())
+
+
+def metrics_prometheus(request) -> HttpResponse:
+    """Get the instrumentation and the runtime metrics in the Prometheus text format via GET."""
+
+    if request.method != "GET":
+        return IncorrectAccessMethod()
+
+    return HttpResponse(
+        instrumentation.registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+def invalidate_cache(request) -> JsonResponse:
+    """
+    Invalidate cached verifications and location owners via POST.
+
+    Requires the `CACHE_INVALIDATION_TOKEN` in the `X-Invalidation-Token` header.
+    With the local cache, only the cache of the process serving the request is invalidated.
+    """
+
+    if request.method != "POST":
+        return IncorrectAccessMethod()
+
+    token = request.META.get("HTTP_X_INVALIDATION_TOKEN", "")
+    if not settings.CACHE_INVALIDATION_TOKEN \
+            or not hmac.compare_digest(token.encode(), settings.CACHE_INVALIDATION_TOKEN.encode()):
+        return IncorrectCredentials()
+
+    try:
+        data = json.loads(request.body)
+    except JSONDecodeError:
+        return MalformedJson()
+
+    if not isinstance(data, dict):
+        return MalformedJson()
+
+    session_key, user_id = data.get("session_key"), data.get("user_id")
+    location_id = data.get("location_id")
+    if not (session_key and user_id) and not location_id:
+        return MalformedJson()
+
+    if session_key and user_id:
+        cache.invalidate_user(session_key, user_id)
+    if location_id:
+        cache.invalidate_location(location_id)
+
+    return SuccessResponse()
+
+
+@instrumentation.timed("orders_step_duration_seconds", step="verify_user")
 def verify_user(data: dict) -> tuple:
     """Verify the user with the verification service."""
     session_key = data.get("session_key")
@@ -89,35 +183,37 @@ def verify_user(data: dict) -> tuple:
     if not user_id:
         raise ValueError()
 
-    # send a post request to the verification service endpoint
-    response = requests.post(
-        "{}/verification/verify/".format(settings.VERIFICATION_SERVICE_URL),
-        data=json.dumps({"session_key": session_key, "user_id": user_id})
+    verified = cache.verifications.lookup(
+        (session_key, user_id), lambda: request_verification(session_key, user_id)
     )
-
-    if response.status_code is not 200:
+    if not verified:
         raise ValueError()
 
     return user_id, session_key
 
 
-def verify_location_owner(user_id, location_id):
-    """Verify, that the user is the location owner."""
+@instrumentation.timed("orders_upstream_duration_seconds", service="verification")
+def request_verification(session_key, user_id) -> bool:
+    """Request the verification of the user from the verification service."""
 
-    # send a get request to the locations service endpoint
-    response = requests.get("{}/locations/get/{}/".format(
-        settings.LOCATIONS_SERVICE_URL, location_id
-    ))
+    # send a post request to the verification service endpoint
+    response = upstream.post(
+        "verification", "/verification/verify/",
+        data=json.dumps({"session_key": session_key, "user_id": user_id})
+    )
+    # only definitive answers are cached, errors of the service are raised instead
+    upstream.check_response("verification", response)
 
-    if response.status_code is not 200:
-        raise ValueError()
+    return response.status_code == 200
 
-    location_data = response.json()
 
-    if not location_data:
-        raise ValueError()
+@instrumentation.timed("orders_step_duration_seconds", step="verify_location_owner")
+def verify_location_owner(user_id, location_id):
+    """Verify, that the user is the location owner."""
+    location_user_id = cache.location_owners.lookup(
+        (location_id,), lambda: request_location_owner(location_id)
+    )
 
-    location_user_id = location_data.get("user_id")
     if not location_user_id:
         raise ValueError()
 
@@ -125,35 +221,60 @@ def verify_location_owner(user_id, location_id):
         raise ValueError()
 
 
-def fetch_code() -> str:
-    """Fetch a new code from the codes service."""
-    response = requests.get("{}/codes/new/".format(
-        settings.CODES_SERVICE_URL
-    ))
+@instrumentation.timed("orders_upstream_duration_seconds", service="locations")
+def request_location_owner(location_id):
+    """Request the id of the location owner from the locations service."""
 
-    if response.status_code is not 200:
-        raise ValueError()
+    # send a get request to the locations service endpoint
+    response = upstream.get("locations", "/locations/get/{}/".format(location_id))
+    upstream.check_response("locations", response)
 
-    code_data = response.json()
+    if response.status_code != 200:
+        return None
 
     try:
-        return code_data["value"]
-    except KeyError:
-        raise ValueError()
+        location_data = response.json()
+    except ValueError:
+        return None
+
+    if not location_data:
+        return None
 
+    return location_data.get("user_id")
 
-def get_session(request, session_code) -> JsonResponse:
-    """Get a session via GET."""
+
+def session_etag(session_code, sequence) -> str:
+    return quote_etag("{}-{}".format(session_code, sequence))
+
+
+def get_session(request, session_code) -> HttpResponse:
+    """
+    Get a session via GET.
+
+    The response carries an ETag, which changes with every session event.
+    Requests with a matching `If-None-Match` header get a 304 response.
+    """
 
     if request.method != "GET":
         return IncorrectAccessMethod()
 
-    try:
-        session = Session.objects.get(code__exact=session_code)
-    except Session.DoesNotExist:
+    sequence = Session.objects \
+        .filter(code__exact=session_code) \
+        .values_list("sequence", flat=True) \
+        .first()
+    if sequence is None:
         return SessionNotFound()
 
-    return SuccessResponse(session.dict_representation)
+    response = get_conditional_response(request, etag=session_etag(session_code, sequence))
+    if response is None:
+        try:
+            sequence, snapshot = snapshot_cache.get(session_code, sequence)
+        except Session.DoesNotExist:
+            return SessionNotFound()
+        response = EncodedResponse(snapshot)
+
+    response["ETag"] = session_etag(session_code, sequence)
+    return response
 
 
 def close_session(request, session_code) -> JsonResponse:
@@ -162,15 +283,20 @@ def close_session(request, session_code) -> JsonResponse:
     if request.method != "POST":
         return IncorrectAccessMethod()
 
+    # in the buffered mode, the orders in the log are inserted before the session is closed
+    if settings.ORDER_INGESTION == "buffered":
+        close = ingestion.order_log.close_session
+    else:
+        close = models.close_session
+
     try:
-        session = Session.objects.get(code__exact=session_code)
+        session = close(session_code)
     except Session.DoesNotExist:
         return SessionNotFound()
 
-    session.state = SessionState.CLOSED.value
-    session.save()
-
-    return SuccessResponse(session.dict_representation)
+    # the session, which was broadcast, is cached and returned
+    _, snapshot = snapshot_cache.put(session)
+    return EncodedResponse(snapshot)
 
 
 def create_session(request) -> JsonResponse:
@@ -188,38 +314,53 @@ def create_session(request) -> JsonResponse:
         user_id, _ = verify_user(data)
     except ValueError:
         return IncorrectCredentials()
-    except requests.ConnectionError:
+    except upstream.ServiceUnavailable:
         return VerificationServiceUnavailable()
 
     location_id, name = data.get("location_id"), data.get("name")
     if not location_id or not name:
         return MalformedJson()
 
+    # the code is only taken for verified users, and if the pool is empty,
+    # it is fetched concurrently with the verification of the location owner
+    code_future = codes.pool.take()
+
     try:
         verify_location_owner(user_id, location_id)
     except ValueError:
+        codes.pool.give_back(code_future)
         return IncorrectCredentials()
-    except requests.ConnectionError:
+    except upstream.ServiceUnavailable:
+        codes.pool.give_back(code_future)
         return LocationsServiceUnavailable()
 
     try:
-        code = fetch_code()
-    except (requests.ConnectionError, ValueError):
+        with instrumentation.timer("orders_step_duration_seconds", step="fetch_code"):
+            code = code_future.result()
+    except (upstream.ServiceUnavailable, ValueError):
         return CodeServiceUnavailable()
 
     try:
-        session = Session.objects.create(
-            name=name,
-            code=code,
-            location_id=location_id,
-        )
+        with instrumentation.timer("orders_step_duration_seconds", step="insert_session"):
+            session = Session.objects.create(
+                name=name,
+                code=code,
+                location_id=location_id,
+            )
     except IntegrityError:
         return DuplicateSession()
 
-    return SuccessResponse(session.dict_representation)
+    return SuccessResponse(serialize_session(session))
 
 def find_session(request) -> JsonResponse:
-    """Find sessions via GET."""
+    """
+    Find sessions via GET.
+
+    Sessions are returned in pages of `MAX_RESULTS`, ordered by their
+    creation. If there are more sessions, the `X-Next-Cursor` header
+    contains the `cursor` parameter for the next page. With the `stream`
+    parameter, all sessions after the cursor are streamed instead.
+    """
 
     if request.method != "GET":
         return IncorrectAccessMethod()
@@ -232,17 +373,77 @@ def find_session(request) -> JsonResponse:
 
     state = request.GET.get("state")
     if state:
-        sessions = sessions.filter(state__iexact=state)
+        # states are stored in upper case, so that the index is used
+        sessions = sessions.filter(state__exact=state.upper())
 
-    sessions = sessions[:settings.MAX_RESULTS]
+    try:
+        sessions = after_cursor(sessions, request.GET.get("cursor"))
+    except ValueError:
+        return MalformedCursor()
 
-    return SuccessResponse(
-        [
-            session.dict_representation
-            for session in sessions
-        ],
-        safe=False
-    )
+    if request.GET.get("stream"):
+        return StreamingHttpResponse(
+            stream_sessions(sessions), content_type="application/json"
+        )
+
+    # fetch one more session to know if there is a next page
+    rows = read_sessions(sessions[:settings.MAX_RESULTS + 1])
+    sessions = attach_orders(rows[:settings.MAX_RESULTS])
+
+    response = SuccessResponse(sessions, safe=False)
+    if len(rows) > settings.MAX_RESULTS:
+        response["X-Next-Cursor"] = encode_cursor(sessions[-1])
+    return response
+
+
+def get_archived_session(request, session_code) -> HttpResponse:
+    """Get the last archived session with the code via GET."""
+
+    if request.method != "GET":
+        return IncorrectAccessMethod()
+
+    payload = ArchivedSession.objects \
+        .filter(code__exact=session_code) \
+        .order_by("-timestamp") \
+        .values_list("payload", flat=True) \
+        .first()
+    if payload is None:
+        return SessionNotFound()
+
+    return EncodedResponse(payload.encode())
+
+
+def find_archived_session(request) -> HttpResponse:
+    """
+    Find archived sessions via GET.
+
+    Like `find_session`, but only reads the archive. The archived
+    sessions are returned as they were encoded on archival.
+    """
+
+    if request.method != "GET":
+        return IncorrectAccessMethod()
+
+    sessions = ArchivedSession.objects.all()
+
+    location_id = request.GET.get("location_id")
+    if location_id:
+        sessions = sessions.filter(location_id__exact=location_id)
+
+    try:
+        sessions = after_cursor(sessions, request.GET.get("cursor"))
+    except ValueError:
+        return MalformedCursor()
+
+    # fetch one more session to know if there is a next page
+    rows = list(sessions.values_list("timestamp", "code", "payload")[:settings.MAX_RESULTS + 1])
+    payloads = ",".join(payload for _, _, payload in rows[:settings.MAX_RESULTS])
+
+    response = EncodedResponse("[{}]".format(payloads).encode())
+    if len(rows) > settings.MAX_RESULTS:
+        timestamp, code, _ = rows[settings.MAX_RESULTS - 1]
+        response["X-Next-Cursor"] = encode_cursor({"timestamp": timestamp, "code": code})
+    return response
 
 
 def add_product_to_session(request) -> JsonResponse:
@@ -256,22 +457,91 @@ def add_product_to_session(request) -> JsonResponse:
     except JSONDecodeError:
         return MalformedJson()
 
+    if not isinstance(data, dict):
+        return MalformedJson()
+
     product_id = data.get("product_id")
     session_code = data.get("session_code")
-    if not product_id or not session_code:
+    if not valid_product_id(product_id) or not session_code or not isinstance(session_code, str):
         return MalformedJson()
 
+    # in the buffered mode, the order is inserted in the background
+    if settings.ORDER_INGESTION == "buffered":
+        try:
+            entry = ingestion.order_log.append(session_code, product_id)
+        except Session.DoesNotExist:
+            return SessionNotFound()
+        if entry is None:
+            return SessionClosed()
+        return OrderAccepted(entry)
+
+    # the order is only inserted into an open session
     try:
-        session = Session.objects.get(pk=session_code)
+        session = models.add_order(session_code, product_id)
     except Session.DoesNotExist:
         return SessionNotFound()
+    if session is None:
+        return SessionClosed()
 
-    if session.state == SessionState.CLOSED.value:
-        return  SessionClosed()
+    # the session, which was broadcast, is cached and returned
+    _, snapshot = snapshot_cache.put(session)
+    return EncodedResponse(snapshot)
 
-    Order.objects.create(
-        product_id=product_id,
-        session=session
-    )
 
-    return SuccessResponse(session.dict_representation)
+def add_products_to_sessions(request) -> JsonResponse:
+    """
+    Create orders for several products and sessions at once via POST.
+
+    The orders are given as a list of `session_code`, `product_id`
+    and optional `quantity`. They are inserted in one transaction,
+    and the affected sessions are returned.
+    """
+
+    if request.method != "POST":
+        return IncorrectAccessMethod()
+
+    try:
+        data = json.loads(request.body)
+    except JSONDecodeError:
+        return MalformedJson()
+
+    items = data.get("orders") if isinstance(data, dict) else None
+    if not items or not isinstance(items, list):
+        return MalformedJson()
+
+    for item in items:
+        if not isinstance(item, dict):
+            return MalformedJson()
+        session_code = item.get("session_code")
+        quantity = item.get("quantity", 1)
+        if not valid_product_id(item.get("product_id")) \
+                or not session_code or not isinstance(session_code, str) \
+                or not isinstance(quantity, int) or isinstance(quantity, bool) or quantity < 1:
+            return MalformedJson()
+
+    # the limit is checked before the orders are expanded by their quantities
+    if sum(item.get("quantity", 1) for item in items) > settings.MAX_BULK_ORDERS:
+        return MalformedJson()
+
+    products = []
+    for item in items:
+        products += [(item["session_code"], item["product_id"])] * item.get("quantity", 1)
+
+    session_codes = {session_code for session_code, _ in products}
+    with transaction.atomic():
+        # the sessions stay open until the orders are inserted
+        sessions = lock_open_sessions(session_codes)
+        if len(sessions) != len(session_codes):
+            if Session.objects.filter(code__in=session_codes).count() != len(session_codes):
+                return SessionNotFound()
+            return SessionClosed()
+
+        place_orders([
+            Order(session=sessions[session_code], product_id=product_id)
+            for session_code, product_id in products
+        ])
+
+    return SuccessResponse(
+        serialize_sessions(Session.objects.filter(code__in=sessions)),
+        safe=False
+    )